@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+"""
+benchmark suite for the personal data tools.
+
+Results are printed one per line and can be saved as JSON with --json.
+--compare BASE NEW matches the results of both runs on their bench and
+parameters, reports the rates and durations of NEW worse than BASE by
+more than --threshold, the other outcomes that changed and the results
+missing from NEW, and exits with 1 when there are any
+"""
+import argparse
+import contextlib
+from functools import partial
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+from encrypt_password import (are_valid, hash_password, hash_passwords,
+                              is_valid)
+import filtered_logger
+from filtered_logger import (PII_FIELDS, ConnectionPool,
+                             QueuedRedactingHandler, RedactingFormatter,
+                             export_users, export_users_parallel,
+                             filter_datum)
+from redact_logs import redact_file
+
+USERS_COLUMNS = ("name", "email", "phone", "ssn", "password", "ip",
+                 "last_login", "user_agent")
+
+
+def legacy_filter_datum(fields: List[str], redaction: str, message: str,
+                        separator: str) -> str:
+    """
+    the previous filter_datum: one compiled regex and one scan per field
+    """
+    for field in fields:
+        message = re.sub(f"{field}=.*?{separator}",
+                         f"{field}={redaction}{separator}", message)
+    return message
+
+
+def make_message(length: int, fields: List[str], seed: int = 0,
+                 density: float = 0.0) -> str:
+    """
+    builds a `key=value;` message of about length characters holding
+    every field in fields plus filler keys, each filler key being one of
+    fields with probability density
+    """
+    rand = random.Random(seed)
+    parts = []
+    size = 0
+    keys = list(fields)
+    while size < length or keys:
+        if keys:
+            key = keys.pop()
+        elif rand.random() < density:
+            key = rand.choice(fields)
+        else:
+            key = "k{}".format(rand.randint(0, 999))
+        value = "".join(rand.choices(string.ascii_letters, k=12))
+        part = "{}={};".format(key, value)
+        parts.append(part)
+        size += len(part)
+    rand.shuffle(parts)
+    return "".join(parts)
+
+
+def lines_per_second(func: Callable[[str], str], messages: List[str],
+                     min_time: float = 0.2) -> float:
+    """
+    runs func over messages until min_time elapsed, returns lines/sec
+    """
+    lines = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        for message in messages:
+            func(message)
+        lines += len(messages)
+        elapsed = time.perf_counter() - start
+    return lines / elapsed
+
+
+def bench_filter_datum(lengths: List[int], field_counts: List[int],
+                       densities: List[float],
+                       min_time: float) -> List[Dict]:
+    """
+    compares filter_datum against legacy_filter_datum
+    """
+    results = []
+    for count in field_counts:
+        fields = list(PII_FIELDS[:count])
+        for density in densities:
+            for length in lengths:
+                messages = [make_message(length, fields, seed, density)
+                            for seed in range(50)]
+                legacy = lines_per_second(
+                    lambda m: legacy_filter_datum(fields, "***", m, ";"),
+                    messages, min_time)
+                current = lines_per_second(
+                    lambda m: filter_datum(fields, "***", m, ";"),
+                    messages, min_time)
+                results.append({"bench": "filter_datum", "fields": count,
+                                "density": density, "length": length,
+                                "legacy_lines_per_sec": round(legacy),
+                                "lines_per_sec": round(current),
+                                "speedup": round(current / legacy, 2)})
+    return results
+
+
+def bench_formatter(lengths: List[int], min_time: float) -> List[Dict]:
+    """
+    measures RedactingFormatter.format end to end against a plain
+    Formatter followed by legacy_filter_datum
+    """
+    results = []
+    fields = list(PII_FIELDS)
+    formatter = RedactingFormatter(fields)
+    plain = logging.Formatter(RedactingFormatter.FORMAT)
+    for length in lengths:
+        records = [logging.LogRecord("user_data", logging.INFO, __file__,
+                                     0, make_message(length, fields, seed),
+                                     None, None)
+                   for seed in range(50)]
+        legacy = lines_per_second(
+            lambda r: legacy_filter_datum(fields, "***", plain.format(r),
+                                          ";"),
+            records, min_time)
+        current = lines_per_second(formatter.format, records, min_time)
+        results.append({"bench": "formatter", "length": length,
+                        "legacy_lines_per_sec": round(legacy),
+                        "lines_per_sec": round(current),
+                        "speedup": round(current / legacy, 2)})
+    return results
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """
+    returns the pct percentile of samples
+    """
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def bench_logger_latency(records: int, length: int) -> List[Dict]:
+    """
+    measures the time logger.info takes in the calling thread with a
+    synchronous StreamHandler and with a QueuedRedactingHandler
+    """
+    results = []
+    message = make_message(length, list(PII_FIELDS))
+    formatter = RedactingFormatter(list(PII_FIELDS))
+    with open(os.devnull, "w") as devnull:
+        for mode in ("sync", "queued"):
+            if mode == "sync":
+                handler = logging.StreamHandler(devnull)
+                handler.setFormatter(formatter)
+            else:
+                handler = QueuedRedactingHandler(formatter, stream=devnull,
+                                                 maxsize=records)
+            logger = logging.Logger("bench_" + mode, logging.INFO)
+            logger.addHandler(handler)
+            samples = []
+            start = time.perf_counter()
+            for _ in range(records):
+                before = time.perf_counter()
+                logger.info(message)
+                samples.append(time.perf_counter() - before)
+            handler.close()
+            total = time.perf_counter() - start
+            results.append({"bench": "logger_latency", "mode": mode,
+                            "length": length,
+                            "p50_us": round(percentile(samples, 50) * 1e6, 1),
+                            "p99_us": round(percentile(samples, 99) * 1e6, 1),
+                            "records_per_sec": round(records / total)})
+    return results
+
+
+def bench_structured(min_time: float) -> List[Dict]:
+    """
+    compares RedactingFormatter.format on flat `key=value;` messages
+    (regex redaction) with the same rows logged as mappings
+    """
+    results = []
+    row = dict(zip(USERS_COLUMNS, (
+        "Marlene Wood", "hwestiii@att.net", "(473) 401-4253", "261-72-6780",
+        "K5?BMNv", "60ed:c396:2ff:244:bbd0:9208:26f2:93ea",
+        "2019-11-14 06:14:24", "Mozilla/5.0 (Windows NT 10.0; Win64)")))
+    text = " ".join(f"{k}={v};" for k, v in row.items())
+    for json_lines in (False, True):
+        formatter = RedactingFormatter(list(PII_FIELDS), json_lines)
+        for kind, msg in (("regex", text), ("mapping", row)):
+            record = logging.LogRecord("user_data", logging.INFO, __file__,
+                                       0, msg, None, None)
+            rate = lines_per_second(lambda _: formatter.format(record),
+                                    [None] * 100, min_time)
+            results.append({"bench": "structured",
+                            "output": "json" if json_lines else "text",
+                            "path": kind, "lines_per_sec": round(rate)})
+    return results
+
+
+def make_users_db(path: str, rows: int, seed: int = 0):
+    """
+    creates a SQLite users table shaped like the MySQL one, holding rows
+    generated rows
+    """
+    rand = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.execute("DROP TABLE IF EXISTS users")
+    db.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, {})".format(
+        ", ".join("{} TEXT".format(c) for c in USERS_COLUMNS)))
+
+    def generate():
+        for i in range(rows):
+            yield ("user {}".format(i), "user{}@example.com".format(i),
+                   "({:03}) {:03}-{:04}".format(rand.randint(0, 999),
+                                                rand.randint(0, 999),
+                                                i % 10000),
+                   "{:03}-{:02}-{:04}".format(i % 1000, i % 100, i % 10000),
+                   "".join(rand.choices(string.ascii_letters, k=12)),
+                   "10.0.{}.{}".format(i // 256 % 256, i % 256),
+                   "2019-11-14 06:14:24", "Mozilla/5.0 (X11; Linux x86_64)")
+    db.executemany("INSERT INTO users ({}) VALUES ({})".format(
+        ", ".join(USERS_COLUMNS), ", ".join("?" * len(USERS_COLUMNS))),
+        generate())
+    db.commit()
+    db.close()
+
+
+def bench_export(rows: int, batch_size: int) -> List[Dict]:
+    """
+    compares main(), one log call per row, with the batched
+    export_users on a generated SQLite users table
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, \
+            open(os.devnull, "w") as devnull:
+        path = os.path.join(tmp, "users.db")
+        make_users_db(path, rows)
+
+        db = sqlite3.connect(path)
+        start = time.perf_counter()
+        with contextlib.redirect_stderr(devnull):
+            filtered_logger.main(db)
+        seconds = time.perf_counter() - start
+        logging.getLogger("user_data").handlers.clear()
+        db.close()
+        results.append({"bench": "export", "mode": "row", "rows": rows,
+                        "rows_per_sec": round(rows / seconds)})
+
+        db = sqlite3.connect(path)
+        stats = export_users(db, devnull, batch_size)
+        db.close()
+        results.append({"bench": "export", "mode": "stream", "rows": rows,
+                        "batch_size": batch_size,
+                        "rows_per_sec": round(stats["rows_per_sec"]),
+                        "peak_memory_kb": stats["peak_memory_kb"]})
+    return results
+
+
+def bench_pool(units: int) -> List[Dict]:
+    """
+    runs units of work (one small query each) on a new connection per
+    unit and on connections checked out of a ConnectionPool
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "users.db")
+        make_users_db(path, 100)
+        connect = partial(sqlite3.connect, path, check_same_thread=False)
+
+        start = time.perf_counter()
+        for i in range(units):
+            db = connect()
+            db.execute("SELECT * FROM users WHERE id = ?", (i % 100,))
+            db.close()
+        seconds = time.perf_counter() - start
+        results.append({"bench": "connections", "mode": "connect",
+                        "units": units, "connections_opened": units,
+                        "us_per_unit": round(seconds / units * 1e6, 1)})
+
+        pool = ConnectionPool(connect, size=4, max_age=60)
+        start = time.perf_counter()
+        for i in range(units):
+            with pool.connection() as db:
+                db.execute("SELECT * FROM users WHERE id = ?", (i % 100,))
+        seconds = time.perf_counter() - start
+        pool.close()
+        results.append({"bench": "connections", "mode": "pool",
+                        "units": units,
+                        "connections_opened": pool.stats["opened"],
+                        "handshakes_saved": pool.stats["reused"],
+                        "us_per_unit": round(seconds / units * 1e6, 1)})
+    return results
+
+
+def bench_parallel(rows: int, workers: List[int],
+                   batch_size: int) -> List[Dict]:
+    """
+    runs export_users_parallel on a generated SQLite users table for
+    each worker count
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, \
+            open(os.devnull, "w") as devnull:
+        path = os.path.join(tmp, "users.db")
+        make_users_db(path, rows)
+        connect = partial(sqlite3.connect, path)
+        for count in workers:
+            stats = export_users_parallel(connect, count, devnull,
+                                          batch_size=batch_size)
+            results.append({"bench": "parallel_export", "workers": count,
+                            "rows": stats["rows"],
+                            "rows_per_sec": round(stats["rows_per_sec"]),
+                            "workers_peak_memory_kb":
+                                stats["workers_peak_memory_kb"]})
+    return results
+
+
+def bench_redact(lines: int, workers: List[int],
+                 chunk_sizes: List[int]) -> List[Dict]:
+    """
+    redacts a generated log of lines lines with redact_file for each
+    worker count, after checking that every chunk size in chunk_sizes,
+    small enough to cut lines and fields, gives the output of
+    filter_datum on the whole text
+    """
+    results = []
+    fields = list(PII_FIELDS)
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "app.log")
+        dst = os.path.join(tmp, "app.redacted.log")
+        sample = "\n".join(make_message(80, fields, seed)
+                           for seed in range(20))
+        # the last line has no line break
+        with open(src, "w") as f:
+            f.write("x\n" + sample)
+        expected = filter_datum(fields, "***", "x\n" + sample, ";")
+        for chunk_size in chunk_sizes:
+            redact_file(src, dst, fields, "***", ";", 1, chunk_size)
+            with open(dst) as f:
+                if f.read() != expected:
+                    raise AssertionError("redact_file output differs from "
+                                         "filter_datum with chunk_size={}"
+                                         .format(chunk_size))
+
+        with open(src, "w") as f:
+            for seed in range(lines):
+                f.write(make_message(256, fields, seed) + "\n")
+        size = os.path.getsize(src)
+        for count in workers:
+            start = time.perf_counter()
+            redact_file(src, dst, fields, "***", ";", count)
+            seconds = time.perf_counter() - start
+            results.append({"bench": "redact", "workers": count,
+                            "lines": lines,
+                            "mb_per_sec": round(size / 1e6 / seconds, 1)})
+    return results
+
+
+def bench_hashing(count: int, workers: List[int]) -> List[Dict]:
+    """
+    hashes and checks count passwords with hash_passwords/are_valid for
+    each worker count, in threads and in processes
+    """
+    results = []
+    passwords = ["password{}".format(i) for i in range(count)]
+    for processes in (False, True):
+        for number in workers:
+            hashed, checked = {}, {}
+            hashes = hash_passwords(passwords, number, processes, hashed)
+            are_valid(zip(hashes, passwords), number, processes, checked)
+            results.append({"bench": "hashing",
+                            "pool": "process" if processes else "thread",
+                            "workers": number, "count": count,
+                            "hash_per_sec": round(hashed["per_second"], 2),
+                            "check_per_sec": round(checked["per_second"],
+                                                   2)})
+    return results
+
+
+def bench_bcrypt(costs: List[int], count: int) -> List[Dict]:
+    """
+    measures hash_password and is_valid at each bcrypt cost
+    """
+    results = []
+    for cost in costs:
+        start = time.perf_counter()
+        hashes = [hash_password("password{}".format(i), cost)
+                  for i in range(count)]
+        hashed = time.perf_counter() - start
+        start = time.perf_counter()
+        for i, hashed_password in enumerate(hashes):
+            is_valid(hashed_password, "password{}".format(i))
+        checked = time.perf_counter() - start
+        results.append({"bench": "bcrypt", "cost": cost, "count": count,
+                        "hash_per_sec": round(count / hashed, 2),
+                        "check_per_sec": round(count / checked, 2)})
+    return results
+
+
+# bench name -> keys of its results set by the command line or the
+# bench loops; every other key is a measured outcome
+PARAMETERS = {
+    "filter_datum": ("fields", "density", "length"),
+    "formatter": ("length",),
+    "logger_latency": ("mode", "length"),
+    "structured": ("output", "path"),
+    "export": ("mode", "rows", "batch_size"),
+    "connections": ("mode", "units"),
+    "parallel_export": ("workers",),
+    "redact": ("workers", "lines"),
+    "hashing": ("pool", "workers", "count"),
+    "bcrypt": ("cost", "count"),
+}
+HIGHER_IS_BETTER = ("_per_sec", "speedup", "_saved")
+LOWER_IS_BETTER = ("_us", "_per_unit", "_kb", "_opened")
+
+
+def result_id(result: Dict) -> Tuple:
+    """
+    returns the bench name and parameters identifying a result across
+    runs
+    """
+    keys = PARAMETERS.get(result.get("bench"), ())
+    return ((("bench", result.get("bench")),) +
+            tuple((k, result.get(k)) for k in keys))
+
+
+def describe(result_key: Tuple) -> str:
+    """
+    returns the bench name and parameters of a result_id as text
+    """
+    return " ".join("{}={}".format(k, v) for k, v in result_key
+                    if v is not None)
+
+
+def compare(base: List[Dict], new: List[Dict],
+            threshold: float) -> Tuple[List[str], List[str]]:
+    """
+    returns one line per outcome of new worse than the same outcome of
+    base: by more than threshold (a fraction) for rates and durations,
+    any change for the other outcomes (counts), and one line per result
+    of base missing from new. Then one line per result only in new
+    """
+    regressions = []
+    previous = {result_id(result): result for result in base}
+    seen = set()
+    for result in new:
+        result_key = result_id(result)
+        old = previous.get(result_key)
+        if old is None:
+            continue
+        seen.add(result_key)
+        parameters = {k for k, _ in result_key}
+        for key, value in result.items():
+            if key in parameters:
+                continue
+            line = "{} {}: {} -> {}".format(describe(result_key), key,
+                                            old.get(key), value)
+            if key.endswith(HIGHER_IS_BETTER + LOWER_IS_BETTER):
+                if not old.get(key):
+                    continue
+                change = (value - old[key]) / old[key]
+                if key.endswith(LOWER_IS_BETTER):
+                    change = -change
+                if change < -threshold:
+                    regressions.append("{} ({:+.1%})".format(line, change))
+            elif value != old.get(key):
+                regressions.append(line)
+    regressions.extend("{}: missing from the new run".format(describe(k))
+                       for k in previous if k not in seen)
+    added = [describe(result_id(result)) for result in new
+             if result_id(result) not in previous]
+    return regressions, added
+
+
+def print_results(results: List[Dict]):
+    """
+    prints one line per result
+    """
+    for result in results:
+        print(" ".join("{}={}".format(k, v) for k, v in result.items()))
+
+
+def main():
+    """
+    parses the command line and runs the benchmarks
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHES),
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--json", help="file to save the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"),
+                        help="compare two saved runs instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--lengths", type=int, nargs="+",
+                        default=[64, 256, 1024, 4096])
+    parser.add_argument("--fields", type=int, nargs="+",
+                        default=[1, 3, 5])
+    parser.add_argument("--densities", type=float, nargs="+",
+                        default=[0.0, 0.5])
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--units", type=int, default=10000)
+    parser.add_argument("--parallel-rows", type=int, default=1000000)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--redact-lines", type=int, default=100000)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+",
+                        default=[1, 4, 7, 64, 1000])
+    parser.add_argument("--passwords", type=int, default=32)
+    parser.add_argument("--costs", type=int, nargs="+",
+                        default=[4, 8, 10, 12])
+    args = parser.parse_args()
+
+    if args.compare:
+        runs = []
+        for path in args.compare:
+            with open(path) as f:
+                runs.append(json.load(f)["results"])
+        regressions, added = compare(runs[0], runs[1], args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line)
+        for line in added:
+            print("NEW " + line + ": not in the base run")
+        sys.exit(1 if regressions else 0)
+
+    results = []
+    for name in args.only or BENCHES:
+        bench_results = BENCHES[name](args)
+        print_results(bench_results)
+        results.extend(bench_results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "cpus": os.cpu_count(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "args": vars(args),
+                       "results": results}, f, indent=2)
+
+
+BENCHES = {
+    "filter_datum": lambda a: bench_filter_datum(a.lengths, a.fields,
+                                                 a.densities, a.min_time),
+    "formatter": lambda a: bench_formatter(a.lengths, a.min_time),
+    "logger_latency": lambda a: [r for length in a.lengths
+                                 for r in bench_logger_latency(a.records,
+                                                               length)],
+    "structured": lambda a: bench_structured(a.min_time),
+    "export": lambda a: bench_export(a.rows, a.batch_size),
+    "pool": lambda a: bench_pool(a.units),
+    "parallel": lambda a: bench_parallel(a.parallel_rows, a.workers,
+                                         a.batch_size),
+    "redact": lambda a: bench_redact(a.redact_lines, a.workers,
+                                     a.chunk_sizes),
+    "hashing": lambda a: bench_hashing(a.passwords, a.workers),
+    "bcrypt": lambda a: bench_bcrypt(a.costs, a.passwords),
+}
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,175 @@
 Hashing and encrypting passwords module
 """
 import bcrypt
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import os
+import platform
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
 
-def hash_password(password: str) -> bytes:
+DEFAULT_COST = 12
+MAX_COST = 31
+_target_cost = None
+
+
+def cost_file() -> str:
+    """ Returns the file the calibrated cost is saved to """
+    return os.environ.get("BCRYPT_COST_FILE", ".bcrypt_cost.json")
+
+
+def _hash_time(cost: int, samples: int = 3) -> float:
+    """ Returns the best of samples hashing times at cost, in seconds """
+    salt = bcrypt.gensalt(cost)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", salt)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def calibrate_cost(budget_ms: float = None, min_cost: int = None,
+                   persist: bool = True) -> int:
+    """
+    measures bcrypt on this machine and returns the largest cost whose
+    hashing time fits in budget_ms (BCRYPT_BUDGET_MS, 250 by default),
+    never below min_cost (BCRYPT_MIN_COST, 10 by default).
+    Each extra cost unit doubles the work, so only min_cost is timed.
+    The result becomes the target cost and is saved to cost_file()
+    unless persist is False
+    """
+    global _target_cost
+    if budget_ms is None:
+        budget_ms = float(os.environ.get("BCRYPT_BUDGET_MS", 250))
+    if min_cost is None:
+        min_cost = int(os.environ.get("BCRYPT_MIN_COST", 10))
+    measured_ms = _hash_time(min_cost) * 1000
+    cost = min_cost
+    while cost < MAX_COST and measured_ms * 2 ** (cost + 1 - min_cost) \
+            <= budget_ms:
+        cost += 1
+    _target_cost = cost
+    if persist:
+        with open(cost_file(), "w") as f:
+            json.dump({"cost": cost, "budget_ms": budget_ms,
+                       "min_cost": min_cost,
+                       "min_cost_ms": measured_ms,
+                       "host": platform.node()}, f)
+    return cost
+
+
+def target_cost() -> int:
+    """
+    Returns the cost new hashes are made with: BCRYPT_COST when set,
+    else the last calibration of this process or saved in cost_file(),
+    else bcrypt's default
+    """
+    global _target_cost
+    if os.environ.get("BCRYPT_COST"):
+        return int(os.environ["BCRYPT_COST"])
+    if _target_cost is None:
+        try:
+            with open(cost_file()) as f:
+                _target_cost = int(json.load(f)["cost"])
+        except (OSError, ValueError, KeyError, TypeError):
+            _target_cost = DEFAULT_COST
+    return _target_cost
+
+
+def hash_cost(hashed_password: bytes) -> int:
+    """ Returns the cost a bcrypt hash was made with """
+    return int(hashed_password.split(b"$")[2])
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """ Tells whether a hash was made below the target cost """
+    return hash_cost(hashed_password) < target_cost()
+
+
+def hash_password(password: str, rounds: int = None) -> bytes:
     """
     function that expects one string argument name password and
     returns a salted, hashed password, which is a byte string.
+    rounds defaults to target_cost()
     """
     pass_encod = password.encode()
-    hash_pass = bcrypt.hashpw(pass_encod, bcrypt.gensalt())
+    if rounds is None:
+        rounds = target_cost()
+    hash_pass = bcrypt.hashpw(pass_encod, bcrypt.gensalt(rounds))
     return hash_pass
 
 
-def is_valid(hashed_password: bytes, password: str) -> bool:
-    """ Validates the provided password matches the hashed password """
+def is_valid(hashed_password: bytes, password: str,
+             on_weak_hash: Callable[[bytes], None] = None) -> bool:
+    """ Validates the provided password matches the hashed password
+        on_weak_hash is called with the hash when the password is valid
+        but the hash was made below the target cost, so it can be rehashed
+    """
     pass_encod = password.encode()
-    return bcrypt.checkpw(pass_encod, hashed_password)
+    valid = bcrypt.checkpw(pass_encod, hashed_password)
+    if valid and on_weak_hash is not None and needs_rehash(hashed_password):
+        on_weak_hash(hashed_password)
+    return valid
+
+
+def _bounded_map(func: Callable, items: Iterable[Tuple], workers: int,
+                 processes: bool) -> Iterator:
+    """
+    calls func on every tuple of items in a thread (or process) pool,
+    with at most two calls per worker in flight, and yields the results
+    in input order
+    """
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(workers) as executor:
+        pending = deque()
+        for item in items:
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, *item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _run_batch(func: Callable, items: Iterable[Tuple], workers: int,
+               processes: bool, stats: Dict) -> List:
+    """
+    runs func over items with _bounded_map, filling stats with the
+    count, the duration and the throughput when given
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    start = time.perf_counter()
+    results = list(_bounded_map(func, items, workers, processes))
+    if stats is not None:
+        seconds = time.perf_counter() - start
+        stats.update({"count": len(results), "seconds": seconds,
+                      "per_second": len(results) / seconds
+                      if seconds else 0.0})
+    return results
+
+
+def hash_passwords(passwords: Iterable[str], workers: int = None,
+                   processes: bool = False, stats: Dict = None
+                   ) -> List[bytes]:
+    """
+    hashes every password of passwords over a pool of workers (CPU
+    count by default) and returns the hashes in input order.
+    bcrypt releases the GIL, so threads are used unless processes is set
+    """
+    return _run_batch(hash_password, ((p,) for p in passwords),
+                      workers, processes, stats)
+
+
+def are_valid(pairs: Iterable[Tuple[bytes, str]], workers: int = None,
+              processes: bool = False, stats: Dict = None) -> List[bool]:
+    """
+    checks every (hashed_password, password) pair of pairs over a pool
+    of workers and returns the results in input order
+    """
+    return _run_batch(is_valid, pairs, workers, processes, stats)
+
+
+if __name__ == "__main__":
+    print("bcrypt cost for this machine: {}".format(calibrate_cost()))
@@ -3,25 +3,59 @@
 filtered logger module
 """
 
+import atexit
+from contextlib import contextmanager
+from functools import lru_cache
+import io
+import json
 import logging
+from logging.handlers import QueueHandler
+import multiprocessing
 import mysql.connector
 import os
+import queue
 import re
-from typing import List
+import resource
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Mapping, Tuple
 
 
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
 
 
+@lru_cache(maxsize=64)
+def redaction_rules(fields: Tuple[str, ...], redaction: str,
+                    separator: str) -> Tuple[Tuple[Callable, str], ...]:
+    """
+    compiles the substitution of every field once and caches it per
+    (fields, redaction, separator) set. A precompiled literal-prefixed
+    pattern per field is scanned faster by `re` than one alternation
+    of all fields, so the rules are applied one after the other.
+    """
+    if len(separator) == 1:
+        value = "[^{}\\n]*".format(re.escape(separator))
+    else:
+        value = ".*?"
+    rules = []
+    for field in fields:
+        pattern = re.compile(f"{re.escape(field)}={value}"
+                             f"{re.escape(separator)}")
+        replacement = f"{field}={redaction}{separator}"
+        rules.append((pattern.sub, replacement.replace("\\", "\\\\")))
+    return tuple(rules)
+
+
 def filter_datum(fields: List[str], redaction: str, message: str,
                  separator: str) -> str:
     """
     The goal is to take a log message and hide or
     obscure certain sensitive information within it.
     """
-    for field in fields:
-        message = re.sub(f"{field}=.*?{separator}",
-                         f"{field}={redaction}{separator}", message)
+    for sub, replacement in redaction_rules(tuple(fields), redaction,
+                                            separator):
+        message = sub(replacement, message)
     return message
 
 
@@ -33,35 +67,200 @@ class RedactingFormatter(logging.Formatter):
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], json_lines: bool = False):
         """
-        an init method
+        an init method, json_lines formats each record as a JSON object
         """
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.json_lines = json_lines
+        self._field_set = frozenset(fields)
+        self._rules = redaction_rules(tuple(fields), self.REDACTION,
+                                      self.SEPARATOR)
 
     def format(self, record: logging.LogRecord) -> str:
         """
         filter the values in log records using
-        filter_datum implemented above
+        filter_datum implemented above.
+        Mapping messages are redacted by key before being serialized,
+        without any regex
         """
+        if isinstance(record.msg, Mapping):
+            data = self.redact_mapping(record.msg)
+            if self.json_lines:
+                return self._format_json(record, data)
+            msg, args = record.msg, record.args
+            record.msg = " ".join(f"{k}={str(v)}{self.SEPARATOR}"
+                                  for k, v in data.items())
+            record.args = None
+            try:
+                return super(RedactingFormatter, self).format(record)
+            finally:
+                record.msg, record.args = msg, args
+        if self.json_lines:
+            return self._format_json(record,
+                                     self.redact(record.getMessage()))
         msg = super(RedactingFormatter, self).format(record)
-        return filter_datum(self.fields, self.REDACTION, msg,
-                            self.SEPARATOR)
+        return self.redact(msg)
+
+    def _format_json(self, record: logging.LogRecord, message) -> str:
+        """
+        serializes a record holding an already redacted message
+        as one line of JSON
+        """
+        entry = {"name": record.name,
+                 "levelname": record.levelname,
+                 "asctime": self.formatTime(record, self.datefmt),
+                 "message": message}
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+    def formatException(self, ei) -> str:
+        """
+        formats an exception with its message redacted: on the mapping
+        path the message is redacted by key, not the traceback
+        """
+        return self.redact(super(RedactingFormatter, self)
+                           .formatException(ei))
+
+    def redact_mapping(self, data: Mapping) -> Dict:
+        """
+        returns a copy of data where the value of every field is redacted
+        """
+        fields = self._field_set
+        return {k: self.REDACTION if k in fields else v
+                for k, v in data.items()}
+
+    def redact(self, text: str) -> str:
+        """
+        redacts every field of text with the precompiled rules
+        """
+        for sub, replacement in self._rules:
+            text = sub(replacement, text)
+        return text
+
+
+class QueuedRedactingHandler(QueueHandler):
+    """ Queue handler that formats and writes records on a background
+        thread, in batches
+        """
+
+    OVERFLOW_POLICIES = ("block", "drop", "count")
+    _STOP = object()
+
+    def __init__(self, formatter: logging.Formatter, stream=None,
+                 maxsize: int = 10000, overflow: str = "block",
+                 batch_size: int = 256):
+        """
+        an init method, overflow tells what to do when the queue is
+        full: block the caller, drop the record or drop and count it
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}"
+                             .format(", ".join(self.OVERFLOW_POLICIES)))
+        super(QueuedRedactingHandler, self).__init__(queue.Queue(maxsize))
+        self.setFormatter(formatter)
+        self.stream = sys.stderr if stream is None else stream
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_batches,
+                                        name="redacting-log-writer",
+                                        daemon=True)
+        self._writer.start()
 
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        merges the %-args of a record, or copies its mapping message, so
+        it logs them as they are now, not as they are when the writer
+        thread gets to it; formatting and redaction are left to the
+        writer thread
+        """
+        if isinstance(record.msg, Mapping):
+            record.msg = dict(record.msg)
+        elif record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
 
-def get_logger() -> logging.Logger:
+    def enqueue(self, record: logging.LogRecord):
+        """
+        puts a record on the queue following the overflow policy
+        """
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == "count":
+                with self._dropped_lock:
+                    self.dropped += 1
+
+    def _write_batches(self):
+        """
+        drains the queue, formatting and writing up to batch_size
+        records per write, until the stop marker is read
+        """
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not self._STOP \
+                    and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._STOP
+            if stop:
+                batch.pop()
+            lines = []
+            for record in batch:
+                try:
+                    lines.append(self.format(record) + "\n")
+                except Exception:
+                    self.handleError(record)
+            if lines:
+                try:
+                    self.stream.write("".join(lines))
+                    self.stream.flush()
+                except Exception:
+                    self.handleError(batch[-1])
+            if stop:
+                return
+
+    def close(self):
+        """
+        writes the pending records and stops the writer thread
+        """
+        if self._writer.is_alive():
+            self.queue.put(self._STOP)
+            self._writer.join()
+        super(QueuedRedactingHandler, self).close()
+
+
+def get_logger(queued: bool = False, maxsize: int = 10000,
+               overflow: str = "block", batch_size: int = 256,
+               json_lines: bool = False) -> logging.Logger:
     """
     function that takes no arguments and returns a
     logging.Logger object.
+    When queued is set, records are redacted and written by a
+    background thread instead of the caller's thread.
     """
     logger = logging.getLogger("user_data")
     logger.setLevel(logging.INFO)
     logger.propagate = False
 
-    str_handler = logging.StreamHandler()
-    formatter = RedactingFormatter(list(PII_FIELDS))
-    str_handler.setFormatter(formatter)
+    formatter = RedactingFormatter(list(PII_FIELDS), json_lines)
+    if queued:
+        str_handler = QueuedRedactingHandler(formatter, maxsize=maxsize,
+                                             overflow=overflow,
+                                             batch_size=batch_size)
+    else:
+        str_handler = logging.StreamHandler()
+        str_handler.setFormatter(formatter)
     logger.addHandler(str_handler)
 
     return logger
@@ -82,21 +281,339 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
                                    database=db_name)
 
 
-def main():
+class ConnectionPool:
+    """ Pool of reusable database connections
+        """
+
+    def __init__(self, connect: Callable = None, size: int = None,
+                 max_age: float = None, timeout: float = None):
+        """
+        an init method, connect opens a new DB-API connection and
+        defaults to get_db, unset options are read from
+        PERSONAL_DATA_DB_POOL_SIZE, PERSONAL_DATA_DB_POOL_MAX_AGE
+        (seconds) and PERSONAL_DATA_DB_POOL_TIMEOUT (seconds)
+        """
+        env = os.environ.get
+        self.connect = get_db if connect is None else connect
+        self.size = int(env("PERSONAL_DATA_DB_POOL_SIZE", 5)) \
+            if size is None else size
+        self.max_age = float(env("PERSONAL_DATA_DB_POOL_MAX_AGE", 300)) \
+            if max_age is None else max_age
+        self.timeout = float(env("PERSONAL_DATA_DB_POOL_TIMEOUT", 30)) \
+            if timeout is None else timeout
+        self.stats = {"opened": 0, "reused": 0, "recycled": 0,
+                      "unhealthy": 0}
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._opened_at = {}
+        self._lock = threading.Lock()
+
+    def _count(self, stat: str):
+        """
+        increments one of the stats
+        """
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _discard(self, conn):
+        """
+        closes a connection that leaves the pool
+        """
+        self._opened_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def is_healthy(conn) -> bool:
+        """
+        checks that the server still answers on conn
+        """
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        """
+        checks a connection out of the pool, idle connections older than
+        max_age or failing the health check are replaced by new ones
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("no database connection available")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                age = time.monotonic() - self._opened_at[id(conn)]
+                if age > self.max_age:
+                    self._count("recycled")
+                    self._discard(conn)
+                elif not self.is_healthy(conn):
+                    self._count("unhealthy")
+                    self._discard(conn)
+                else:
+                    self._count("reused")
+                    return conn
+            conn = self.connect()
+            self._opened_at[id(conn)] = time.monotonic()
+            self._count("opened")
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard: bool = False):
+        """
+        returns a connection to the pool, or closes it when discard is set
+        """
+        if discard:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """
+        context manager checking a connection out and back in
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            try:
+                conn.rollback()
+                self.release(conn)
+            except Exception:
+                self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def close(self):
+        """
+        closes every idle connection
+        """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
     """
-    obtain a database connection using get_db and retrieve all rows
-    in the users table and display each row under a filtered format
+    returns the connection pool shared by the module, created on first
+    use around get_db
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+            atexit.register(_pool.close)
+        return _pool
+
+
+def _write_batches(cursor, stream, batch_size: int) -> int:
+    """
+    writes the rows of an executed cursor to stream under the filtered
+    format, redacting and writing batch_size rows at a time, returns
+    the number of rows written
+    """
+    formatter = RedactingFormatter(list(PII_FIELDS))
+    fields = [column[0] for column in cursor.description]
+    rows = 0
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return rows
+        record = logging.LogRecord("user_data", logging.INFO, __file__, 0,
+                                   "", None, None)
+        prefix = logging.Formatter.format(formatter, record)
+        lines = [prefix + " ".join(f"{f}={str(r)};"
+                                   for f, r in zip(fields, row))
+                 for row in batch]
+        stream.write(formatter.redact("\n".join(lines) + "\n"))
+        rows += len(batch)
+
+
+def _export_stats(rows: int, start: float, workers: Dict = None) -> Dict:
+    """
+    returns the stats reported by the exports, with the peak memory of
+    the worker processes summed when the export ran in workers, workers
+    mapping their pids to their peaks
     """
-    db = get_db()
+    seconds = time.perf_counter() - start
+    stats = {"rows": rows,
+             "seconds": seconds,
+             "rows_per_sec": rows / seconds if seconds else 0.0,
+             "peak_memory_kb": resource.getrusage(
+                 resource.RUSAGE_SELF).ru_maxrss}
+    if workers is not None:
+        stats["workers_peak_memory_kb"] = sum(workers.values())
+    return stats
+
+
+def export_users(db, stream=None, batch_size: int = 1000) -> Dict:
+    """
+    streams the users table to stream under the filtered format,
+    fetching, redacting and writing batch_size rows at a time.
+    Returns the number of rows, rows/sec and the peak memory (KB)
+    """
+    stream = sys.stderr if stream is None else stream
+    start = time.perf_counter()
+    # mysql.connector cursors are unbuffered by default: rows stay on
+    # the server until fetched
     cursor = db.cursor()
     cursor.execute("SELECT * FROM users;")
-    fields = cursor.column_names
-    logger = get_logger()
-    for row in cursor:
-        msg = "".join(f"{f}={str(r)}; "for f, r in zip(fields, row))
-        logger.info(msg.strip())
+    rows = _write_batches(cursor, stream, batch_size)
+    stream.flush()
     cursor.close()
-    db.close()
+    return _export_stats(rows, start)
+
+
+def _export_shard(connect: Callable, key: str, low: int, high: int,
+                  batch_size: int, path: str = None) -> Tuple[int, str]:
+    """
+    formats the users whose key is in [low, high) on a new connection,
+    returns the number of rows and the formatted text, or writes the
+    text to path and returns path instead
+    """
+    db = connect()
+    try:
+        cursor = db.cursor()
+        cursor.execute(f"SELECT * FROM users WHERE {key} >= {int(low)} "
+                       f"AND {key} < {int(high)} ORDER BY {key};")
+        if path is None:
+            stream = io.StringIO()
+            rows = _write_batches(cursor, stream, batch_size)
+            output = stream.getvalue()
+        else:
+            with open(path, "w") as stream:
+                rows = _write_batches(cursor, stream, batch_size)
+            output = path
+        cursor.close()
+    finally:
+        db.close()
+    return rows, output
+
+
+def export_users_parallel(connect: Callable = None, workers: int = None,
+                          stream=None, key: str = None, shards: int = None,
+                          output_dir: str = None,
+                          batch_size: int = 1000) -> Dict:
+    """
+    splits the users table into ranges of its integer key and formats
+    each range in a pool of worker processes, each worker opening its
+    own connection with connect (get_db by default).
+    Shards are written to stream in key order, or to one file per shard
+    in output_dir. Returns the same stats as export_users, plus the
+    peak memory (KB) of the workers, summed.
+    key goes into the queries as it is, so it must be a column name
+    """
+    connect = get_db if connect is None else connect
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    key = os.environ.get("PERSONAL_DATA_EXPORT_KEY", "id") \
+        if key is None else key
+    if not key.isidentifier():
+        raise ValueError("export key must be a column name, not {!r}"
+                         .format(key))
+    shards = workers * 4 if shards is None else shards
+    stream = sys.stderr if stream is None else stream
+    start = time.perf_counter()
+
+    db = connect()
+    try:
+        cursor = db.cursor()
+        cursor.execute(f"SELECT MIN({key}), MAX({key}) FROM users;")
+        low, high = cursor.fetchone()
+        cursor.close()
+    finally:
+        db.close()
+    if low is None:
+        return _export_stats(0, start, {})
+    step = -(-(high + 1 - low) // shards)
+    jobs = []
+    for index, bound in enumerate(range(low, high + 1, step)):
+        path = None
+        if output_dir is not None:
+            path = os.path.join(output_dir, "users-{:04}.log".format(index))
+        jobs.append((connect, key, bound, bound + step, batch_size, path))
+
+    rows = 0
+    peaks = {}
+    with multiprocessing.Pool(workers) as pool:
+        for count, output, pid, peak in pool.imap(_starred_export_shard,
+                                                  jobs):
+            rows += count
+            peaks[pid] = max(peaks.get(pid, 0), peak)
+            if output_dir is None:
+                stream.write(output)
+    stream.flush()
+    return _export_stats(rows, start, peaks)
+
+
+def _starred_export_shard(job: Tuple) -> Tuple[int, str, int, int]:
+    """
+    unpacks a job for Pool.imap, adding the pid and peak memory (KB) of
+    the worker that ran it
+    """
+    rows, output = _export_shard(*job)
+    return (rows, output, os.getpid(),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main(db=None):
+    """
+    obtain a database connection using get_db and retrieve all rows
+    in the users table and display each row under a filtered format.
+    PERSONAL_DATA_EXPORT_MODE=stream exports in batches of
+    PERSONAL_DATA_EXPORT_BATCH_SIZE rows instead of one log call per row.
+    Without db, a connection is checked out of the shared pool.
+    PERSONAL_DATA_EXPORT_MODE=parallel splits the export across
+    PERSONAL_DATA_EXPORT_WORKERS processes by PERSONAL_DATA_EXPORT_KEY.
+    Rows are logged as mappings, PERSONAL_DATA_LOG_FORMAT=json logs them
+    as JSON lines
+    """
+    mode = os.environ.get("PERSONAL_DATA_EXPORT_MODE", "row")
+    batch_size = int(os.environ.get("PERSONAL_DATA_EXPORT_BATCH_SIZE",
+                                    1000))
+    if mode == "parallel":
+        workers = os.environ.get("PERSONAL_DATA_EXPORT_WORKERS")
+        stats = export_users_parallel(
+            workers=None if workers is None else int(workers),
+            batch_size=batch_size)
+    elif db is None:
+        with get_pool().connection() as db:
+            return main(db)
+    elif mode == "stream":
+        stats = export_users(db, batch_size=batch_size)
+    else:
+        cursor = db.cursor()
+        cursor.execute("SELECT * FROM users;")
+        fields = [column[0] for column in cursor.description]
+        json_lines = os.environ.get("PERSONAL_DATA_LOG_FORMAT") == "json"
+        logger = get_logger(json_lines=json_lines)
+        for row in cursor:
+            logger.info(dict(zip(fields, row)))
+        cursor.close()
+        return
+    summary = ("exported {rows} rows in {seconds:.2f}s ({rows_per_sec:.0f} "
+               "rows/sec, peak memory {peak_memory_kb} KB".format(**stats))
+    if "workers_peak_memory_kb" in stats:
+        summary += ", {workers_peak_memory_kb} KB in workers".format(**stats)
+    print(summary + ")", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+redacts PII fields from existing log files
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from typing import List, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, filter_datum
+
+CHUNK_SIZE = 8 << 20
+
+
+def line_boundaries(path: str, parts: int) -> List[Tuple[int, int]]:
+    """
+    splits the file at path into at most parts byte ranges, every range
+    starting at the beginning of a line
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, "rb") as f:
+        for index in range(1, parts):
+            f.seek(max(size * index // parts, offsets[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > offsets[-1]:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def redact_range(src: str, dst: str, start: int, end: int,
+                 fields: List[str], redaction: str, separator: str,
+                 chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    redacts bytes [start, end) of src into dst, chunk_size bytes at a
+    time cut at the last line break, returns the number of bytes read
+    """
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        fin.seek(start)
+        remaining = end - start
+        carry = b""
+        while remaining > 0:
+            chunk = fin.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            cut = chunk.rfind(b"\n") + 1
+            if cut == 0:
+                # no line ends in this chunk: its line goes on in the
+                # next one or is the last, redacted whole after the loop
+                carry += chunk
+                continue
+            block, carry = carry + chunk[:cut], chunk[cut:]
+            text = block.decode("utf-8", "surrogateescape")
+            text = filter_datum(fields, redaction, text, separator)
+            fout.write(text.encode("utf-8", "surrogateescape"))
+        if carry:
+            text = carry.decode("utf-8", "surrogateescape")
+            text = filter_datum(fields, redaction, text, separator)
+            fout.write(text.encode("utf-8", "surrogateescape"))
+    return end - start
+
+
+def _starred_redact_range(job: Tuple) -> int:
+    """
+    unpacks a job for Pool.imap
+    """
+    return redact_range(*job)
+
+
+def redact_file(src: str, dst: str, fields: List[str], redaction: str,
+                separator: str, workers: int = 1,
+                chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    writes a redacted copy of src to dst. With several workers, each
+    process redacts one byte range into a part file and the parts are
+    concatenated in order. Returns the number of bytes read
+    """
+    ranges = line_boundaries(src, workers)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        return redact_range(src, dst, start, end, fields, redaction,
+                            separator, chunk_size)
+    jobs = [(src, "{}.part{}".format(dst, index), start, end, fields,
+             redaction, separator, chunk_size)
+            for index, (start, end) in enumerate(ranges)]
+    with multiprocessing.Pool(workers) as pool:
+        total = sum(pool.imap(_starred_redact_range, jobs))
+    with open(dst, "wb") as fout:
+        for job in jobs:
+            with open(job[1], "rb") as part:
+                shutil.copyfileobj(part, fout, CHUNK_SIZE)
+            os.remove(job[1])
+    return total
+
+
+def main():
+    """
+    parses the command line and redacts the input log
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", help="log file to redact")
+    parser.add_argument("output", help="redacted copy to write")
+    parser.add_argument("--fields", nargs="+", default=list(PII_FIELDS))
+    parser.add_argument("--redaction", default=RedactingFormatter.REDACTION)
+    parser.add_argument("--separator", default=RedactingFormatter.SEPARATOR)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    size = redact_file(args.input, args.output, args.fields, args.redaction,
+                       args.separator, args.workers, args.chunk_size)
+    seconds = time.perf_counter() - start
+    print("redacted {:.1f} MB in {:.2f}s ({:.1f} MB/s)".format(
+        size / 1e6, seconds, size / 1e6 / seconds if seconds else 0.0),
+        file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
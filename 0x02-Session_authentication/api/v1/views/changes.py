@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+""" Module of the change feed views
+"""
+from api.v1.views import app_views
+from flask import jsonify, request
+from models.base import change_feed
+
+
+@app_views.route('/changes', methods=['GET'], strict_slashes=False)
+def view_changes() -> str:
+    """ GET /api/v1/changes
+    Query parameters:
+      - since (optional): cursor returned by the previous call
+      - limit (optional): maximum number of changes (100 by default,
+        1000 at most)
+    Return:
+      - the changes after since (op, class, id and version of each) and
+        the cursor of the next call; without since, no change and the
+        current cursor, to take before reading all objects
+      - 400 if since or limit is not a valid number
+      - 410 if changes after since are no longer kept
+    """
+    since = request.args.get('since', type=int)
+    limit = request.args.get('limit', 100, type=int)
+    if limit < 0 or ('since' in request.args and since is None):
+        return jsonify({'error': "Wrong format"}), 400
+    feed = change_feed()
+    if since is None:
+        return jsonify({'cursor': feed.cursor, 'changes': []})
+    changes = feed.changes(since, min(limit, 1000))
+    if changes is None:
+        return jsonify({'error': "Cursor expired"}), 410
+    cursor = changes[-1]['version'] if changes else since
+    return jsonify({'cursor': cursor, 'changes': changes})
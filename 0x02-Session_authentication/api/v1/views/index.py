@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """ Module of Index views
 """
-from flask import jsonify, abort
+from flask import jsonify, abort, request
+from os import getenv
 from api.v1.views import app_views
 
 
@@ -19,10 +20,47 @@ def stats() -> str:
     """ GET /api/v1/stats
     Return:
       - the number of each objects
+      - the durability window of the deferred storage mode, once used
     """
+    from models import base
     from models.user import User
     stats = {}
     stats['users'] = User.count()
+    if base.FLUSHER is not None:
+        stats['flusher'] = base.FLUSHER.stats()
+    return jsonify(stats)
+
+
+@app_views.route('/stats/memory', strict_slashes=False)
+def memory_stats() -> str:
+    """ GET /api/v1/stats/memory
+    Query parameters:
+      - sample (optional): objects measured per class (100 by default)
+      - trace (optional): 1 to return the allocations grown since the
+        previous call with trace=1 (the first one starts tracemalloc),
+        0 to stop tracing
+    Return:
+      - for each class: objects count, estimated bytes of the objects and
+        of the indexes, last load and save durations
+      - 400 if sample is not a positive number
+      - 403 if the current user is not listed in ADMIN_EMAILS
+    """
+    from models.base import Base
+    from models.user import User
+    user = getattr(request, 'current_user', None)
+    admins = [email for email in getenv('ADMIN_EMAILS', '').split(',')
+              if email]
+    if user is None or user.email not in admins:
+        abort(403)
+    sample = request.args.get('sample', 100, type=int)
+    if sample < 1:
+        return jsonify({'error': "Wrong format"}), 400
+    stats = {'User': User.memory_stats(sample)}
+    trace = request.args.get('trace')
+    if trace == '1':
+        stats['growth'] = Base.memory_growth()
+    elif trace == '0':
+        Base.stop_memory_growth()
     return jsonify(stats)
 
 
@@ -9,10 +9,19 @@ from models.user import User
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters:
+      - limit (optional): maximum number of users
+      - offset (optional): number of users to skip
     Return:
       - list of all User objects JSON represented
+      - 400 if limit or offset is negative
     """
-    all_users = [user.to_json() for user in User.all()]
+    limit = request.args.get('limit', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if (limit is not None and limit < 0) or offset < 0:
+        return jsonify({'error': "Wrong format"}), 400
+    all_users = [user.to_json()
+                 for user in User.query(limit=limit, offset=offset)]
     return jsonify(all_users)
 
 
@@ -0,0 +1,811 @@
+#!/usr/bin/env python3
+"""
+benchmark suite for the models storage.
+
+Every benchmark runs in a temporary directory, so the .db_*.json files
+of the working directory are never touched. Results are printed one per
+line and can be saved as JSON with --json
+"""
+import argparse
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from models import base, storage
+from models.user import User
+
+
+@contextlib.contextmanager
+def workdir(**env: str):
+    """
+    runs the block in a new temporary directory with env set and an
+    empty models store
+    """
+    cwd = os.getcwd()
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            base.DATA.clear()
+            User.load_from_file()
+            yield tmp
+        finally:
+            User.flush()
+            User.truncate_journal()
+            storage.close_backends()
+            base.DATA.clear()
+            base.SHARD_IDS.clear()
+            if base.FEED is not None:
+                base.FEED.close()
+                base.FEED = None
+            os.chdir(cwd)
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+
+def make_users(count: int, seed: int = 0) -> List[User]:
+    """
+    adds count generated users to DATA without saving them
+    """
+    rand = random.Random(seed)
+    users = []
+    for i in range(count):
+        user = User(id="{:032x}".format(rand.getrandbits(128)),
+                    email="user{}@example.com".format(i),
+                    first_name="First{}".format(i % 1000),
+                    last_name="Last{}".format(i % 5000))
+        user.password = "pwd{}".format(i)
+        base.DATA["User"][user.id] = user
+        users.append(user)
+    User.rebuild_indexes()
+    User.publish()
+    return users
+
+
+def bench_write(sizes: List[int], writes: int) -> List[Dict]:
+    """
+    measures the latency of User.save() on stores of each size, for
+    every storage mode
+    """
+    results = []
+    for mode in ("json", "journal", "deferred", "sharded"):
+        for size in sizes:
+            with workdir(MODEL_STORAGE=mode):
+                users = make_users(size)
+                User.save_to_file()
+                rand = random.Random(size)
+                samples = []
+                for _ in range(writes):
+                    user = rand.choice(users)
+                    user.first_name = "Updated"
+                    start = time.perf_counter()
+                    user.save()
+                    samples.append(time.perf_counter() - start)
+                samples.sort()
+                result = {
+                    "bench": "write", "storage": mode, "users": size,
+                    "p50_us": round(samples[len(samples) // 2] * 1e6, 1),
+                    "p99_us": round(samples[int(len(samples) * .99)] * 1e6,
+                                    1)}
+                if mode == "deferred":
+                    User.flush()
+                    result["max_window_ms"] = round(
+                        base.FLUSHER.max_window_ms, 1)
+                results.append(result)
+    return results
+
+
+def bench_search(sizes: List[int], lookups: int) -> List[Dict]:
+    """
+    measures User.search({'email': ...}) through the email index and
+    by scanning, on stores of each size
+    """
+    results = []
+    for size in sizes:
+        with workdir():
+            users = make_users(size)
+            rand = random.Random(size)
+            emails = [rand.choice(users).email for _ in range(lookups)]
+            for path in ("index", "scan"):
+                if path == "scan":
+                    base.INDEX_DATA.pop("User")
+                start = time.perf_counter()
+                for email in emails:
+                    User.search({'email': email})
+                seconds = time.perf_counter() - start
+                results.append({"bench": "search", "path": path,
+                                "users": size,
+                                "us_per_search": round(seconds / lookups
+                                                       * 1e6, 1)})
+    return results
+
+
+def bench_query(sizes: List[int], page: int) -> List[Dict]:
+    """
+    measures one page of users: the first ones through a full
+    User.search() against User.query(limit=...), then pages sorted on
+    created_at taken by offset and by keyset cursor, halfway through
+    """
+    results = []
+    for size in sizes:
+        with workdir():
+            users = make_users(size)
+            start = datetime(2020, 1, 1)
+            for i, user in enumerate(users):
+                user.created_at = start + timedelta(seconds=i % 3600)
+            middle = size // 2
+            cursor = sorted(User.order_key(u, "created_at")
+                            for u in users)[middle - 1]
+            cases = {
+                "search_slice": lambda: User.search()[:page],
+                "query_limit": lambda: list(User.query(limit=page)),
+                "ordered_offset": lambda: list(User.query(
+                    order_by="created_at", offset=middle, limit=page)),
+                "ordered_keyset": lambda: list(User.query(
+                    order_by="created_at", after=cursor, limit=page)),
+            }
+            for name, run in cases.items():
+                runs = 20
+                start_time = time.perf_counter()
+                for _ in range(runs):
+                    run()
+                seconds = (time.perf_counter() - start_time) / runs
+                results.append({"bench": "query", "case": name,
+                                "users": size, "page": page,
+                                "ms_per_page": round(seconds * 1e3, 3)})
+    return results
+
+
+def to_json_generic(obj: User, for_serialization: bool = False) -> Dict:
+    """
+    User.to_json() as it was before the generated serializers
+    """
+    result = {}
+    if base.COMPACT:
+        attributes = ((key, getattr(obj, key)) for key in obj.FIELDS
+                      if hasattr(obj, key))
+    else:
+        attributes = obj.__dict__.items()
+    for key, value in attributes:
+        if not for_serialization and key[0] == '_':
+            continue
+        if type(value) is datetime:
+            result[key] = value.strftime(base.TIMESTAMP_FORMAT)
+        else:
+            result[key] = value
+    return result
+
+
+def bench_serialize(size: int) -> List[Dict]:
+    """
+    measures to_json() on size users against to_json_generic(), for the
+    API, for the files and projected on two fields, after checking that
+    both give the same JSON
+    """
+    results = []
+    with workdir():
+        users = make_users(size)
+        for for_serialization in (False, True):
+            generic = json.dumps([to_json_generic(u, for_serialization)
+                                  for u in users])
+            if json.dumps([u.to_json(for_serialization)
+                           for u in users]) != generic:
+                raise AssertionError("to_json() output changed")
+        cases = {
+            "api": (lambda u: to_json_generic(u),
+                    lambda u: u.to_json()),
+            "file": (lambda u: to_json_generic(u, True),
+                     lambda u: u.to_json(True)),
+            "projection": (lambda u: {k: v for k, v in
+                                      to_json_generic(u).items()
+                                      if k in ("id", "email")},
+                           lambda u: u.to_json(fields=("id", "email"))),
+        }
+        for name, (before, after) in cases.items():
+            seconds = []
+            for run in (before, after):
+                start = time.perf_counter()
+                for user in users:
+                    run(user)
+                seconds.append(time.perf_counter() - start)
+            results.append({"bench": "serialize", "case": name,
+                            "users": size,
+                            "generic_ms": round(seconds[0] * 1e3, 1),
+                            "compiled_ms": round(seconds[1] * 1e3, 1),
+                            "speedup": round(seconds[0] / seconds[1], 2)})
+    return results
+
+
+def bench_load(sizes: List[int], touched: float) -> List[Dict]:
+    """
+    measures User.load_from_file() and the memory it holds, loading
+    eagerly from JSON and lazily from JSON lines, then the time to get
+    a touched fraction of the users
+    """
+    results = []
+    for lazy in ("0", "1"):
+        for size in sizes:
+            with workdir(MODEL_LAZY_LOAD=lazy):
+                ids = [user.id for user in make_users(size)]
+                User.save_to_file()
+                base.DATA.clear()
+                tracemalloc.start()
+                User.load_from_file()
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                base.DATA.clear()
+                start = time.perf_counter()
+                User.load_from_file()
+                load = time.perf_counter() - start
+                sample = random.Random(size).sample(ids, int(size * touched))
+                start = time.perf_counter()
+                for obj_id in sample:
+                    User.get(obj_id)
+                gets = time.perf_counter() - start
+                results.append({"bench": "load",
+                                "format": "jsonl" if lazy == "1" else "json",
+                                "users": size, "touched": touched,
+                                "load_ms": round(load * 1e3, 1),
+                                "memory_kb": memory // 1024,
+                                "get_touched_ms": round(gets * 1e3, 1)})
+    return results
+
+
+def bench_backend(sizes: List[int], writes: int,
+                  lookups: int) -> List[Dict]:
+    """
+    compares the JSON file and SQLite backends on load time, write
+    latency and search latency by email
+    """
+    results = []
+    for mode in ("json", "sqlite"):
+        for size in sizes:
+            with workdir(MODEL_STORAGE=mode):
+                ids = [user.id for user in make_users(size)]
+                User.save_to_file()
+                base.DATA.clear()
+                start = time.perf_counter()
+                User.load_from_file()
+                load = time.perf_counter() - start
+                rand = random.Random(size)
+                samples = []
+                for _ in range(writes):
+                    user = User.get(rand.choice(ids))
+                    user.first_name = "Updated"
+                    start = time.perf_counter()
+                    user.save()
+                    samples.append(time.perf_counter() - start)
+                samples.sort()
+                emails = [User.get(rand.choice(ids)).email
+                          for _ in range(lookups)]
+                start = time.perf_counter()
+                for email in emails:
+                    User.search({'email': email})
+                search = time.perf_counter() - start
+                results.append({
+                    "bench": "backend", "storage": mode, "users": size,
+                    "load_ms": round(load * 1e3, 1),
+                    "write_p50_us": round(samples[len(samples) // 2] * 1e6,
+                                          1),
+                    "write_p99_us": round(
+                        samples[int(len(samples) * .99)] * 1e6, 1),
+                    "us_per_search": round(search / lookups * 1e6, 1)})
+    return results
+
+
+def bench_shards(sizes: List[int], shard_counts: List[int],
+                 writes: int) -> List[Dict]:
+    """
+    compares numbers of shards on the migration from .db_User.json, the
+    parallel load and the latency of User.save()
+    """
+    results = []
+    for size in sizes:
+        for shards in shard_counts:
+            with workdir(MODEL_STORAGE="json"):
+                ids = [user.id for user in make_users(size)]
+                User.save_to_file()
+                os.environ["MODEL_STORAGE"] = "sharded"
+                os.environ["MODEL_SHARDS"] = str(shards)
+                try:
+                    base.DATA.clear()
+                    start = time.perf_counter()
+                    User.load_from_file()
+                    migrate = time.perf_counter() - start
+                    base.DATA.clear()
+                    start = time.perf_counter()
+                    User.load_from_file()
+                    load = time.perf_counter() - start
+                    rand = random.Random(size)
+                    samples = []
+                    for _ in range(writes):
+                        user = User.get(rand.choice(ids))
+                        user.first_name = "Updated"
+                        start = time.perf_counter()
+                        user.save()
+                        samples.append(time.perf_counter() - start)
+                finally:
+                    os.environ["MODEL_STORAGE"] = "json"
+                    del os.environ["MODEL_SHARDS"]
+                samples.sort()
+                results.append({
+                    "bench": "shards", "users": size, "shards": shards,
+                    "migrate_ms": round(migrate * 1e3, 1),
+                    "load_ms": round(load * 1e3, 1),
+                    "write_p50_us": round(samples[len(samples) // 2] * 1e6,
+                                          1),
+                    "write_p99_us": round(
+                        samples[int(len(samples) * .99)] * 1e6, 1)})
+    return results
+
+
+def all_copying() -> List[User]:
+    """
+    User.all() before snapshots: a copy of every ID, then one lookup
+    per object
+    """
+    store = base.DATA["User"]
+    return [store.get(obj_id) for obj_id in tuple(store)]
+
+
+def search_copying() -> List[User]:
+    """
+    User.search() before snapshots: a new list of the live values
+    """
+    return list(filter(lambda obj: User.match(obj, {}, False),
+                       base.DATA["User"].values()))
+
+
+def read_snapshot() -> List[User]:
+    """
+    every object through User.all()
+    """
+    return list(User.all())
+
+
+def stress_reads(read, users: List[User], readers: int,
+                 writes: int) -> Dict:
+    """
+    runs readers threads calling read() while a writer adds and removes
+    users, counting the reads that failed and the ones that saw a
+    removed object or an object twice
+    """
+    done = threading.Event()
+    counts = {"reads": 0, "errors": 0, "inconsistent": 0}
+    lock = threading.Lock()
+
+    def reader():
+        while not done.is_set():
+            try:
+                objs = read()
+                ok = None not in objs and len(
+                    {obj.id for obj in objs}) == len(objs)
+            except RuntimeError:
+                ok = None
+            with lock:
+                counts["reads"] += 1
+                if ok is None:
+                    counts["errors"] += 1
+                elif not ok:
+                    counts["inconsistent"] += 1
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    rand = random.Random(readers)
+    for i in range(writes):
+        user = User(email="stress{}@example.com".format(i))
+        user.save()
+        rand.choice(users).first_name = "Updated"
+        user.remove()
+    done.set()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def bench_snapshot(sizes: List[int], readers: int,
+                   writes: int) -> List[Dict]:
+    """
+    compares reading every user by copying DATA and through the shared
+    snapshot: time and memory allocated per read, then reads failed or
+    inconsistent under concurrent writes, which must be none through
+    the snapshot
+    """
+    results = []
+    # (name, read, whether it must stay consistent under writes)
+    variants = (("copy-all", all_copying, False),
+                ("copy-search", search_copying, False),
+                ("snapshot-all", read_snapshot, True),
+                ("snapshot-search", User.search, True))
+    for size in sizes:
+        with workdir(MODEL_STORAGE="deferred"):
+            users = make_users(size)
+            for name, read, consistent in variants:
+                read()
+                tracemalloc.start()
+                objs = read()
+                allocated = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                del objs
+                repeat = max(1, 1000000 // size)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    read()
+                seconds = (time.perf_counter() - start) / repeat
+                result = {"bench": "snapshot", "read": name,
+                          "users": size,
+                          "us_per_read": round(seconds * 1e6, 1),
+                          "allocated_kb": allocated // 1024}
+                result.update(stress_reads(read, users, readers, writes))
+                if consistent and (result["errors"] or
+                                   result["inconsistent"]):
+                    raise AssertionError(
+                        "snapshot: {} reads failed or inconsistent under "
+                        "writes: {}".format(name, result))
+                results.append(result)
+    return results
+
+
+def bench_threads(size: int, readers_counts: List[int], writers: int,
+                  seconds: float) -> List[Dict]:
+    """
+    measures searches by email in readers threads while writers threads
+    save new users, for each storage mode and number of readers, then
+    checks the file written holds every user
+    """
+    results = []
+    for mode in ("json", "journal", "deferred"):
+        for readers in readers_counts:
+            with workdir(MODEL_STORAGE=mode):
+                emails = [user.email for user in make_users(size)]
+                User.save_to_file()
+                done = threading.Event()
+                counts = {"reads": 0, "writes": 0, "errors": 0}
+                lock = threading.Lock()
+
+                def read(seed):
+                    rand = random.Random(seed)
+                    reads = 0
+                    while not done.is_set():
+                        if not User.search({'email': rand.choice(emails)}):
+                            with lock:
+                                counts["errors"] += 1
+                        reads += 1
+                    with lock:
+                        counts["reads"] += reads
+
+                def write(seed):
+                    writes = 0
+                    while not done.is_set():
+                        User(email="w{}-{}@example.com".format(
+                            seed, writes)).save()
+                        writes += 1
+                    with lock:
+                        counts["writes"] += writes
+
+                threads = ([threading.Thread(target=read, args=(i,))
+                            for i in range(readers)] +
+                           [threading.Thread(target=write, args=(i,))
+                            for i in range(writers)])
+                for thread in threads:
+                    thread.start()
+                time.sleep(seconds)
+                done.set()
+                for thread in threads:
+                    thread.join()
+                User.flush()
+                User.compact()
+                with open(User.snapshot_path()) as f:
+                    stored = len(json.load(f))
+                result = {
+                    "bench": "threads", "storage": mode, "users": size,
+                    "readers": readers, "writers": writers,
+                    "reads_per_s": round(counts["reads"] / seconds),
+                    "writes_per_s": round(counts["writes"] / seconds),
+                    "failed_reads": counts["errors"],
+                    "lost_writes": size + counts["writes"] - stored}
+                if result["failed_reads"] or result["lost_writes"]:
+                    raise AssertionError("threads: reads failed or writes "
+                                         "lost: {}".format(result))
+                results.append(result)
+    return results
+
+
+def bench_changes(sizes: List[int], changes: int) -> List[Dict]:
+    """
+    compares the ways a mirror finds the last changes: reading the whole
+    .db_User.json, reading the change feed in memory, and reading it from
+    its file
+    """
+    results = []
+    for size in sizes:
+        with workdir(MODEL_STORAGE="deferred", MODEL_FEED_PATH="feed.jsonl",
+                     MODEL_FEED_SIZE=str(changes)):
+            users = make_users(size)
+            User.save_to_file()
+            feed = base.change_feed()
+            cursor = feed.cursor
+            rand = random.Random(size)
+            for _ in range(changes):
+                user = rand.choice(users)
+                user.first_name = "Updated"
+                user.save()
+            User.flush()
+            seconds = {}
+            start = time.perf_counter()
+            with open(User.snapshot_path()) as f:
+                json.load(f)
+            seconds["full_read_ms"] = time.perf_counter() - start
+            start = time.perf_counter()
+            read = feed.changes(cursor, changes)
+            seconds["feed_memory_ms"] = time.perf_counter() - start
+            feed.close()
+            start = time.perf_counter()
+            file_feed = base.ChangeFeed(0, "feed.jsonl")
+            read_file = file_feed.changes(cursor, changes)
+            seconds["feed_file_ms"] = time.perf_counter() - start
+            assert len(read) == len(read_file) == changes
+            result = {"bench": "changes", "users": size,
+                      "changes": changes}
+            result.update((key, round(value * 1e3, 3))
+                          for key, value in seconds.items())
+            results.append(result)
+    return results
+
+
+def load_with_init():
+    """
+    loads .db_User.json the way User.load_from_file() did before its
+    bulk path: User(**record) then _index() for every object
+    """
+    with open(".db_User.json") as f:
+        objs_json = json.load(f)
+    objs = base.DATA["User"] = {}
+    User.rebuild_indexes()
+    for obj_id, obj_json in objs_json.items():
+        objs[obj_id] = User(**obj_json)
+        objs[obj_id]._index()
+
+
+def bench_hydrate(sizes: List[int]) -> List[Dict]:
+    """
+    measures User.load_from_file() from JSON against load_with_init(),
+    with the timestamps of the generated users (a few distinct seconds)
+    and with one distinct timestamp per user
+    """
+    results = []
+    for size in sizes:
+        for timestamps in ("repeated", "distinct"):
+            with workdir():
+                users = make_users(size)
+                if timestamps == "distinct":
+                    start = datetime(2020, 1, 1)
+                    for i, user in enumerate(users):
+                        user.created_at = start + timedelta(seconds=i)
+                        user.updated_at = start + timedelta(seconds=2 * i)
+                User.save_to_file()
+                del users
+                seconds = {}
+                for path, load in (("init", load_with_init),
+                                   ("hydrator", User.load_from_file)):
+                    base.DATA.clear()
+                    gc.collect()
+                    start = time.perf_counter()
+                    load()
+                    seconds[path] = time.perf_counter() - start
+                results.append({
+                    "bench": "hydrate", "users": size,
+                    "timestamps": timestamps,
+                    "init_ms": round(seconds["init"] * 1e3, 1),
+                    "hydrator_ms": round(seconds["hydrator"] * 1e3, 1),
+                    "speedup": round(seconds["init"] / seconds["hydrator"],
+                                     2)})
+    return results
+
+
+def shared_worker(job: tuple) -> int:
+    """
+    one process of bench_shared: creates then updates its own users,
+    increments the shared counter user and compacts the store, returns
+    the users it sees
+    """
+    worker, writes = job
+    User.load_from_file()
+    users = []
+    for i in range(writes):
+        user = User(email="w{}-{}@example.com".format(worker, i),
+                    first_name="0")
+        user.save()
+        users.append(user)
+        with User.locked():
+            counter = User.search({'email': "counter"})[0]
+            counter.first_name = str(int(counter.first_name) + 1)
+            counter.save()
+    for user in users:
+        user.first_name = "1"
+        user.save()
+    # the other processes then reload the snapshot, with no journal
+    User.save_to_file()
+    return User.count()
+
+
+def bench_shared(processes: int, writes: int) -> List[Dict]:
+    """
+    runs processes workers writing to one store in the shared mode, with
+    a journal small enough to be compacted along the way, then checks
+    that this process sees every user through snapshot() and that a new
+    load holds every user, every update and every counter increment
+    """
+    with workdir(MODEL_STORAGE="shared", MODEL_JOURNAL_MAX_SIZE="65536"):
+        User(email="counter", first_name="0").save()
+        # snapshot of this process, taken before the workers write
+        User.search()
+        start = time.perf_counter()
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            pool.map(shared_worker, [(w, writes) for w in range(processes)])
+        seconds = time.perf_counter() - start
+        # the workers compacted: this process reloads the snapshot file
+        count = User.count()
+        if len(User.search()) != count or len(list(User.all())) != count:
+            raise AssertionError("shared: snapshot() not renewed after "
+                                 "reloading the changes of the workers")
+        base.DATA.clear()
+        User.load_from_file()
+        counter = User.search({'email': "counter"})[0]
+        updated = len(User.search({'first_name': "1"}))
+        expected = processes * writes
+        result = {"bench": "shared", "processes": processes,
+                  "writes": 3 * expected,
+                  "writes_per_s": round(3 * expected / seconds),
+                  "lost_users": expected + 1 - User.count(),
+                  "lost_updates": expected - updated,
+                  "lost_increments": expected - int(counter.first_name)}
+        if any(result[key] for key in result if key.startswith("lost_")):
+            raise AssertionError("shared: updates lost across processes: "
+                                 "{}".format(result))
+        return [result]
+
+
+def measure_memory(size: int) -> Dict:
+    """
+    returns the memory (tracemalloc) held by size users kept in DATA,
+    and the estimate of User.memory_stats() with the time it takes
+    """
+    base.DATA.setdefault("User", {})
+    tracemalloc.start()
+    make_users(size)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    estimated = User.memory_stats()["total_bytes"]
+    seconds = time.perf_counter() - start
+    return {"bench": "memory", "compact": base.COMPACT, "users": size,
+            "memory_kb": memory // 1024,
+            "bytes_per_user": memory // size,
+            "estimated_kb": estimated // 1024,
+            "memory_stats_ms": round(seconds * 1e3, 2)}
+
+
+def bench_memory(sizes: List[int]) -> List[Dict]:
+    """
+    measures the memory held by the users with and without
+    MODEL_COMPACT, in a new interpreter each time since the option is
+    read when models.base is imported
+    """
+    results = []
+    for compact in ("0", "1"):
+        for size in sizes:
+            env = dict(os.environ, MODEL_COMPACT=compact)
+            output = subprocess.run(
+                [sys.executable, __file__, "--memory-child", str(size)],
+                env=env, check=True, capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            results.append(json.loads(output))
+    return results
+
+
+def print_results(results: List[Dict]):
+    """
+    prints one line per result
+    """
+    for result in results:
+        print(" ".join("{}={}".format(k, v) for k, v in result.items()))
+
+
+def main():
+    """
+    parses the command line and runs the benchmarks
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHES),
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--json", help="file to save the results to")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 50000])
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--page", type=int, default=20,
+                        help="users per page of the query benchmark")
+    parser.add_argument("--serialize-size", type=int, default=100000)
+    parser.add_argument("--touched", type=float, default=0.05,
+                        help="fraction of the users read after a load")
+    parser.add_argument("--memory-sizes", type=int, nargs="+",
+                        default=[100000, 1000000])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--hydrate-sizes", type=int, nargs="+",
+                        default=[100000, 1000000])
+    parser.add_argument("--shards", type=int, nargs="+",
+                        default=[1, 4, 16, 64],
+                        help="numbers of shards compared by the shards "
+                        "bench")
+    parser.add_argument("--readers", type=int, default=4,
+                        help="reading threads of the snapshot bench")
+    parser.add_argument("--threads-size", type=int, default=10000)
+    parser.add_argument("--threads-readers", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--threads-writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=2.0,
+                        help="duration of each run of the threads bench")
+    parser.add_argument("--changes", type=int, default=100,
+                        help="changes read by the changes bench")
+    parser.add_argument("--memory-child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.memory_child:
+        print(json.dumps(measure_memory(args.memory_child)))
+        return
+
+    results = []
+    for name in args.only or BENCHES:
+        bench_results = BENCHES[name](args)
+        print_results(bench_results)
+        results.extend(bench_results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "cpus": os.cpu_count(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "args": vars(args),
+                       "results": results}, f, indent=2)
+
+
+BENCHES = {
+    "write": lambda a: bench_write(a.sizes, a.writes),
+    "search": lambda a: bench_search(a.sizes, a.lookups),
+    "query": lambda a: bench_query(a.sizes, a.page),
+    "serialize": lambda a: bench_serialize(a.serialize_size),
+    "load": lambda a: bench_load(a.sizes, a.touched),
+    "memory": lambda a: bench_memory(a.memory_sizes),
+    "hydrate": lambda a: bench_hydrate(a.hydrate_sizes),
+    "shared": lambda a: bench_shared(a.processes, a.writes),
+    "backend": lambda a: bench_backend(a.sizes, a.writes, a.lookups),
+    "shards": lambda a: bench_shards(a.sizes, a.shards, a.writes),
+    "snapshot": lambda a: bench_snapshot(a.sizes, a.readers, a.writes),
+    "changes": lambda a: bench_changes(a.sizes, a.changes),
+    "threads": lambda a: bench_threads(a.threads_size, a.threads_readers,
+                                       a.threads_writers, a.seconds),
+}
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,802 @@
 #!/usr/bin/env python3
 """ Base module
 """
-from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from datetime import datetime, timedelta
+from typing import Callable, TypeVar, List, Iterable, Iterator
+from os import getenv, path
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import contextlib
+import fcntl
+import gc
+import heapq
+import itertools
 import json
+import mmap
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
 import uuid
+import zlib
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# read once: the models are declared with __slots__ when set
+COMPACT = getenv("MODEL_COMPACT", "0") == "1"
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
 DATA = {}
+JOURNALS = {}
+INDEX_DATA = {}
+INDEX_KEYS = {}
+UNINDEXED = object()
+# types of the index keys a keys file can hold
+JSON_KEYS = (str, int, float, bool, type(None))
+# json.loads() without its checks, for the lines of lazy objects
+DECODE = json.JSONDecoder().decode
+# (class, attribute layout, for_serialization, fields) -> serializer
+SERIALIZERS = {}
+# sharded mode: class name -> IDs of the objects of each shard
+SHARD_IDS = {}
+# class name -> RWLock of its objects in DATA, and lock of its files
+RW_LOCKS = {}
+FILE_LOCKS = {}
+# class name -> (generation, tuple of its objects or None until a reader
+# takes it), a new generation is published when objects come or go
+VERSIONS = {}
+VERSION_LOCK = threading.Lock()
+FLUSHER = None
+FEED = None
+# class name -> durations of its last load and save, in milliseconds
+TIMINGS = {}
+# tracemalloc snapshot of the previous Base.memory_growth() call
+TRACE = None
+# multi-process mode: lock file of each path -> (pid, open file), and
+# class name -> (snapshot_id() of the loaded snapshot, journal offset)
+LOCKS = {}
+SYNC = {}
+# class name -> [users of its flock in this process, whether exclusive],
+# and the lock guarding them
+LOCK_DEPTH = {}
+LOCK_GUARDS = {}
+
+
+def storage_mode() -> str:
+    """ Storage mode of the models: `json` rewrites the whole file on
+    every change, `journal` appends each change to a log, `deferred`
+    rewrites the file in the background, `shared` is the journal shared
+    by several processes, `sharded` splits the file in shards rewritten
+    one at a time, any other mode names a backend of models.storage
+    """
+    return getenv("MODEL_STORAGE", "json")
+
+
+def storage_backend(mode: str = None):
+    """ Backend of the storage mode (storage_mode() by default), None
+    when the objects are kept in DATA and the JSON files
+    """
+    if mode is None:
+        mode = storage_mode()
+    if mode in ("json", "journal", "deferred", "shared", "sharded"):
+        return None
+    from models.storage import BACKENDS
+    if mode not in BACKENDS:
+        return None
+    return BACKENDS[mode]()
+
+
+def snapshot_id(file_path: str) -> tuple:
+    """ Identity of a version of a file: a rewrite replaces it by a new
+    inode with a new modification time
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def keys_path(file_path: str) -> str:
+    """ Path of the keys file of a JSON lines snapshot: the id, offset
+    and index keys of each of its lines
+    """
+    return file_path + ".keys"
+
+
+def write_keys(file_path: str, ids: list, offsets: list, columns: dict):
+    """ Write the keys file of the JSON lines file_path, columns mapping
+    each indexed attribute to the keys of the lines, or remove it when
+    columns is None or holds a key JSON cannot give back
+    """
+    keys_file = keys_path(file_path)
+    if columns is None or not all(type(key) in JSON_KEYS
+                                  for column in columns.values()
+                                  for key in column):
+        if path.exists(keys_file):
+            os.remove(keys_file)
+        return
+    with atomic_write(keys_file) as f:
+        json.dump({"snapshot": snapshot_id(file_path), "ids": ids,
+                   "offsets": offsets, "keys": columns}, f)
+
+
+def journal_max_size() -> int:
+    """ Size of the journal (bytes) above which it is compacted
+    """
+    return int(getenv("MODEL_JOURNAL_MAX_SIZE", 4 * 1024 * 1024))
+
+
+def shard_count() -> int:
+    """ Number of shard files per class in the sharded mode
+    """
+    return int(getenv("MODEL_SHARDS", 16))
+
+
+def shard_of(obj_id, shards: int) -> int:
+    """ Shard of an object: a hash of its ID stable across processes
+    """
+    return zlib.crc32(str(obj_id).encode()) % shards
+
+
+def lazy_load() -> bool:
+    """ Whether objects are stored as JSON lines and only built when
+    first accessed
+    """
+    return getenv("MODEL_LAZY_LOAD", "0") == "1"
+
+
+class RWLock():
+    """ Reader-writer lock: any number of readers or one writer, the
+    waiting writers going first. The writer may read or write again
+    while it holds the lock; a reader may read again but not write
+    """
+
+    def __init__(self):
+        """ Initialize the lock, free
+        """
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting = 0
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def reading(self):
+        """ Context holding the lock shared
+        """
+        reads = getattr(self._local, "reads", 0)
+        if reads or self.writer == threading.get_ident():
+            self._local.reads = reads + 1
+            try:
+                yield
+            finally:
+                self._local.reads = reads
+            return
+        with self.cond:
+            while self.writer is not None or self.waiting:
+                self.cond.wait()
+            self.readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    def reads_held(self) -> bool:
+        """ Whether this thread holds the lock shared only, and so
+        cannot write
+        """
+        return (self.writer != threading.get_ident() and
+                bool(getattr(self._local, "reads", 0)))
+
+    @contextlib.contextmanager
+    def writing(self):
+        """ Context holding the lock exclusive
+        """
+        me = threading.get_ident()
+        if self.writer == me:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            return
+        if getattr(self._local, "reads", 0):
+            raise RuntimeError("cannot write while reading")
+        with self.cond:
+            self.waiting += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+            self.writer = me
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = None
+                self.cond.notify_all()
+
+
+@contextlib.contextmanager
+def atomic_write(file_path: str, mode: str = 'w'):
+    """ File opened to replace file_path: it is written to a temporary
+    file of this process and thread, synced, then renamed over
+    file_path, so readers see the old file or the new one, never a part
+    """
+    tmp_path = "{}.{}-{}.tmp".format(file_path, os.getpid(),
+                                     threading.get_ident())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Flusher():
+    """ Writes the classes changed in deferred mode from a background
+    thread, interval_ms after their oldest unwritten change or as soon
+    as they have max_changes of them
+    """
+
+    def __init__(self, interval_ms: float, max_changes: int):
+        """ Initialize the flusher and start its thread
+        """
+        self.interval = interval_ms / 1000
+        self.max_changes = max_changes
+        self.cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        # class -> [unwritten changes, time of the oldest one]
+        self.dirty = {}
+        self.flushes = 0
+        self.flushed_changes = 0
+        self.last_flush_ms = 0.0
+        self.max_window_ms = 0.0
+        self.failed_flushes = 0
+        self.last_error = None
+        self.thread = threading.Thread(target=self.run, name="flusher",
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def mark(self, cls: type):
+        """ Record one change of cls
+        """
+        with self.cond:
+            entry = self.dirty.get(cls)
+            if entry is None:
+                entry = self.dirty[cls] = [0, time.monotonic()]
+            entry[0] += 1
+            if entry[0] == 1 or entry[0] >= self.max_changes:
+                self.cond.notify()
+
+    def due(self) -> tuple:
+        """ Classes to write now and the seconds until the next one is
+        due (None when nothing is dirty)
+        """
+        now = time.monotonic()
+        due = []
+        timeout = None
+        for cls, (changes, since) in self.dirty.items():
+            wait = since + self.interval - now
+            if changes >= self.max_changes or wait <= 0:
+                due.append(cls)
+            elif timeout is None or wait < timeout:
+                timeout = wait
+        return due, timeout
+
+    def run(self):
+        """ Write the classes as they become due
+        """
+        failures = 0
+        while True:
+            with self.cond:
+                due, timeout = self.due()
+                if not due:
+                    self.cond.wait(timeout)
+                    continue
+            try:
+                for cls in due:
+                    self.flush(cls)
+            except Exception as e:
+                # kept dirty: reported, then retried after a delay doubled
+                # by each failure in a row, up to a minute
+                with self.cond:
+                    self.failed_flushes += 1
+                    self.last_error = "{}: {}".format(type(e).__name__, e)
+                    delay = min(self.interval * 2 ** failures, 60.0)
+                failures += 1
+                traceback.print_exc()
+                time.sleep(delay)
+            else:
+                failures = 0
+
+    def pending(self, cls: type) -> bool:
+        """ Whether cls has unwritten changes
+        """
+        with self.cond:
+            return cls in self.dirty
+
+    def flush(self, cls: type = None):
+        """ Write cls now if it has unwritten changes, every dirty class
+        when cls is None
+        """
+        with self._write_lock:
+            with self.cond:
+                classes = list(self.dirty) if cls is None else [cls]
+                entries = [(c, self.dirty.pop(c)) for c in classes
+                           if c in self.dirty]
+            for c, (changes, since) in entries:
+                start = time.monotonic()
+                try:
+                    c.compact()
+                except BaseException:
+                    with self.cond:
+                        entry = self.dirty.setdefault(c, [0, since])
+                        entry[0] += changes
+                        entry[1] = min(entry[1], since)
+                    raise
+                end = time.monotonic()
+                with self.cond:
+                    self.flushes += 1
+                    self.flushed_changes += changes
+                    self.last_flush_ms = (end - start) * 1e3
+                    self.max_window_ms = max(self.max_window_ms,
+                                             (end - since) * 1e3)
+
+    def stats(self) -> dict:
+        """ Settings and counters of the flusher: max_window_ms is the
+        longest time a change waited to be on disk, last_error the last
+        exception of a failed flush
+        """
+        with self.cond:
+            now = time.monotonic()
+            return {
+                "interval_ms": self.interval * 1e3,
+                "max_changes": self.max_changes,
+                "pending_changes": sum(c for c, _ in self.dirty.values()),
+                "oldest_pending_ms": round(max(
+                    [(now - since) * 1e3 for _, since in
+                     self.dirty.values()] or [0.0]), 3),
+                "flushes": self.flushes,
+                "flushed_changes": self.flushed_changes,
+                "last_flush_ms": round(self.last_flush_ms, 3),
+                "max_window_ms": round(self.max_window_ms, 3),
+                "failed_flushes": self.failed_flushes,
+                "last_error": self.last_error,
+            }
+
+
+def flusher() -> Flusher:
+    """ Flusher of the deferred mode, started on first use with
+    MODEL_FLUSH_INTERVAL_MS (100 by default) and MODEL_FLUSH_MAX_CHANGES
+    (1000 by default)
+    """
+    global FLUSHER
+    if FLUSHER is None:
+        FLUSHER = Flusher(float(getenv("MODEL_FLUSH_INTERVAL_MS", 100)),
+                          int(getenv("MODEL_FLUSH_MAX_CHANGES", 1000)))
+    return FLUSHER
+
+
+class ChangeFeed():
+    """ Changes of the objects (create, update, delete), each numbered
+    by a cursor one greater than the previous one. The last size are
+    kept in a ring buffer, all of them are appended to file_path when
+    it is set. Cursors start from the current time in microseconds (or
+    from the last one of the file), so those of a previous process are
+    never mistaken for new ones
+    """
+
+    def __init__(self, size: int, file_path: str = None):
+        """ Initialize the feed, continuing the file when it exists
+        """
+        self.size = size
+        self.ring = [None] * size
+        self.file_path = file_path
+        self._file = None
+        self._lock = threading.Lock()
+        self.cursor = int(time.time() * 1e6)
+        # cursors up to floor may be missing: the changes after it are
+        # all kept (in the ring while they fit, or in the file)
+        self.floor = self.cursor
+        if file_path is not None and path.exists(file_path):
+            first, last = self._file_bounds()
+            if last is not None:
+                self.cursor = last
+                self.floor = first - 1
+        self.ring_floor = self.cursor
+
+    def _file_bounds(self) -> tuple:
+        """ Cursors of the first and last changes of the file, (None,
+        None) when it has none. A torn last change (crash) is dropped so
+        that the next one is not appended to it
+        """
+        with open(self.file_path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            back = 4096
+            while True:
+                start = max(0, end - back)
+                f.seek(start)
+                tail = f.read()
+                tail = tail[:tail.rfind(b"\n") + 1]
+                lines = tail.splitlines()
+                # the first line read is whole only when start is 0
+                if len(lines) >= 2 or start == 0:
+                    break
+                back *= 2
+            f.truncate(start + len(tail))
+            if not lines:
+                return None, None
+            f.seek(0)
+            first = f.readline()
+        return json.loads(first)["version"], json.loads(lines[-1])["version"]
+
+    def emit(self, op: str, s_class: str, obj_id: str):
+        """ Record one change of an object
+        """
+        with self._lock:
+            self.cursor += 1
+            event = {"version": self.cursor, "op": op, "class": s_class,
+                     "id": obj_id}
+            if self.size:
+                self.ring[self.cursor % self.size] = event
+            if self.file_path is not None:
+                if self._file is None:
+                    self._file = open(self.file_path, 'a')
+                self._file.write(json.dumps(event) + "\n")
+                self._file.flush()
+
+    def changes(self, since: int, limit: int = 100) -> List[dict]:
+        """ At most limit changes after the cursor since, oldest first
+        (the cursor of the last one is the next since). None when some
+        changes after since are no longer kept, or since comes from
+        another feed: the consumer has to read all objects again
+        """
+        with self._lock:
+            cursor = self.cursor
+            ring_floor = max(self.ring_floor, cursor - self.size)
+            if since > cursor:
+                return None
+            if since >= ring_floor:
+                last = min(cursor, since + limit)
+                return [self.ring[c % self.size]
+                        for c in range(since + 1, last + 1)]
+        if self.file_path is None or since < self.floor:
+            return None
+        return self._file_changes(since, limit)
+
+    def _file_changes(self, since: int, limit: int) -> List[dict]:
+        """ Changes after since read from the file, found by bisecting
+        its lines, sorted on their cursors
+        """
+        with open(self.file_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            low, high = 0, f.tell()
+
+            def line_from(offset):
+                # first line starting at or after offset
+                f.seek(max(0, offset - 1))
+                if offset:
+                    f.readline()
+                return f.readline()
+
+            while low < high:
+                middle = (low + high) // 2
+                line = line_from(middle)
+                if not line.endswith(b"\n") or \
+                        json.loads(line)["version"] > since:
+                    high = middle
+                else:
+                    low = middle + 1
+            line = line_from(low)
+            events = []
+            while line.endswith(b"\n") and len(events) < limit:
+                events.append(json.loads(line))
+                line = f.readline()
+        return events
+
+    def close(self):
+        """ Close the file
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def change_feed() -> ChangeFeed:
+    """ Feed of the changes of every class, created on first use with
+    MODEL_FEED_SIZE changes kept in memory (10000 by default) and
+    appended to MODEL_FEED_PATH when set
+    """
+    global FEED
+    if FEED is None:
+        FEED = ChangeFeed(int(getenv("MODEL_FEED_SIZE", 10000)),
+                          getenv("MODEL_FEED_PATH"))
+    return FEED
+
+
+class LazyObjects(dict):
+    """ Objects of one class read from a JSON lines file: each value is
+    the offset of the object's line until the object is first accessed
+    """
+
+    def __init__(self, cls: type, file_path: str):
+        """ Map file_path, keeping the offset of every object and
+        indexing it from the keys file of the snapshot, or from its raw
+        record when the keys file is missing or out of date
+        """
+        super().__init__()
+        self.cls = cls
+        self.hydrated = 0
+        self._build = cls.hydrator()
+        self._lock = threading.Lock()
+        self._open(file_path)
+        if not self._load_keys(file_path):
+            self._scan()
+
+    def _open(self, file_path: str):
+        """ Open and map file_path
+        """
+        self._file = open(file_path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self._snapshot = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+        self._data = b""
+        if stat.st_size:
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+    def _load_keys(self, file_path: str) -> bool:
+        """ Add the objects and their index keys from the keys file of
+        file_path, if it was written with this version of the file
+        """
+        try:
+            with open(keys_path(file_path)) as f:
+                keys = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if (keys.get("snapshot") != self._snapshot or
+                list(keys.get("keys", ())) != list(self.cls.INDEXES)):
+            return False
+        dict.update(self, zip(keys["ids"], keys["offsets"]))
+        self.cls._index_columns(keys["ids"], list(keys["keys"].values()))
+        return True
+
+    def _scan(self):
+        """ Add the objects and index their records, parsed at once: a
+        last line cut by a crash is left out
+        """
+        data = self._data[:self._data.rfind(b"\n") + 1]
+        lines = data.split(b"\n")
+        lines.pop()
+        records = json.loads(b"[" + b",".join(lines) + b"]")
+        ids = [record["id"] for record in records]
+        offsets = itertools.accumulate(map(len, lines),
+                                       lambda offset, size: offset + size + 1,
+                                       initial=0)
+        dict.update(self, zip(ids, offsets))
+        self.cls._index_records(dict(zip(ids, records)))
+
+    def raw_line(self, offset: int) -> bytes:
+        """ Line at offset, the value of an unloaded object read by the
+        caller: the object may be built meanwhile
+        """
+        with self._lock:
+            return self._data[offset:self._data.find(b"\n", offset) + 1]
+
+    def raw_record(self, offset: int) -> dict:
+        """ JSON record of the line at offset
+        """
+        return json.loads(self.raw_line(offset))
+
+    def _hydrate(self, obj_id: str, value):
+        """ Build the object of obj_id if it is still an offset
+        """
+        if not isinstance(value, int):
+            return value
+        with self._lock:
+            value = dict.__getitem__(self, obj_id)
+            if isinstance(value, int):
+                line = self._data[value:self._data.find(b"\n", value)]
+                value = self._build(DECODE(line.decode()))
+                dict.__setitem__(self, obj_id, value)
+                self.hydrated += 1
+        return value
+
+    def __getitem__(self, obj_id: str):
+        """ Object of obj_id, built on first access
+        """
+        return self._hydrate(obj_id, dict.__getitem__(self, obj_id))
+
+    def get(self, obj_id: str, default=None):
+        """ Object of obj_id or default
+        """
+        if obj_id not in self:
+            return default
+        return self[obj_id]
+
+    def values(self):
+        """ Every object, all built
+        """
+        return [self[obj_id] for obj_id in list(self)]
+
+    def items(self):
+        """ Every (id, object) pair, all objects built
+        """
+        return [(obj_id, self[obj_id]) for obj_id in list(self)]
+
+    def rebase(self, file_path: str, offsets: dict):
+        """ Point the unloaded objects at their lines in a rewritten file
+        """
+        with self._lock:
+            self.close()
+            self._open(file_path)
+            for obj_id, offset in offsets.items():
+                if isinstance(dict.get(self, obj_id), int):
+                    dict.__setitem__(self, obj_id, offset)
+
+    def close(self):
+        """ Unmap and close the file
+        """
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+
+def intern_value(value):
+    """ Share the string value between objects in compact mode
+    """
+    if COMPACT and type(value) is str:
+        return sys.intern(value)
+    return value
+
+
+def timestamp_parser(to_value: Callable = None) -> Callable:
+    """ Parser of TIMESTAMP_FORMAT strings like datetime.strptime,
+    caching the value of each distinct string (converted by to_value)
+    in its cache attribute
+    """
+    cache = {}
+
+    def parse(text: str):
+        value = cache.get(text)
+        if value is None:
+            if len(text) == 19 and text[4] == text[7] == '-' and \
+                    text[10] == 'T' and text[13] == text[16] == ':':
+                # the exact TIMESTAMP_FORMAT layout, parsed in C
+                value = datetime.fromisoformat(text)
+            else:
+                value = datetime.strptime(text, TIMESTAMP_FORMAT)
+            if to_value is not None:
+                value = to_value(value)
+            if len(cache) >= 65536:
+                cache.clear()
+            cache[text] = value
+        return value
+    parse.cache = cache
+    return parse
+
+
+def format_timestamp(value: datetime) -> str:
+    """ value.strftime(TIMESTAMP_FORMAT), through isoformat when it
+    gives the same string
+    """
+    if value.tzinfo is None and value.year >= 1000:
+        # positional arguments: keyword parsing costs as much as the call
+        return datetime.isoformat(value, 'T', 'seconds')
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """ Context without cyclic garbage collection, for bulk loads: every
+    object is new and the GC would rescan the growing heap many times
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+@contextlib.contextmanager
+def timed(s_class: str, name: str):
+    """ Context recording its duration in TIMINGS[s_class][name] when
+    it succeeds
+    """
+    start = time.perf_counter()
+    yield
+    TIMINGS.setdefault(s_class, {})[name] = round(
+        (time.perf_counter() - start) * 1e3, 3)
+
+
+def object_size(obj) -> int:
+    """ Approximate bytes of obj with its attribute values (one level
+    deep): values shared by several objects are counted for each
+    """
+    size = sys.getsizeof(obj)
+    attrs = getattr(obj, "__dict__", None)
+    if attrs is not None:
+        size += sys.getsizeof(attrs)
+        values = list(attrs.values())
+    else:
+        values = []
+    for klass in type(obj).__mro__:
+        for name in getattr(klass, "__slots__", ()):
+            values.append(getattr(obj, name, None))
+    for value in values:
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+
+def casefold(value):
+    """ Case-insensitive index key of a value
+    """
+    if not isinstance(value, str):
+        return value
+    folded = value.casefold()
+    # keep the stored string when it is already folded
+    return value if folded == value else folded
 
 
 class Base():
     """ Base class
     """
 
+    # secondary indexes used by search(): attribute name -> key
+    # normalizer (None for exact keys, casefold for case-insensitive ones)
+    INDEXES = {}
+    # attributes of the objects, in serialization order
+    FIELDS = ('id', 'created_at', 'updated_at')
+    # string attributes shared between objects in compact mode
+    INTERNED = ()
+
+    if COMPACT:
+        __slots__ = ('id', '_created_us', '_updated_us')
+
+        @property
+        def created_at(self) -> datetime:
+            """ Creation date, kept in microseconds since the epoch
+            """
+            return EPOCH + self._created_us * MICROSECOND
+
+        @created_at.setter
+        def created_at(self, value: datetime):
+            """ Setter of the creation date
+            """
+            self._created_us = (value - EPOCH) // MICROSECOND
+
+        @property
+        def updated_at(self) -> datetime:
+            """ Update date, kept in microseconds since the epoch
+            """
+            return EPOCH + self._updated_us * MICROSECOND
+
+        @updated_at.setter
+        def updated_at(self, value: datetime):
+            """ Setter of the update date
+            """
+            self._updated_us = (value - EPOCH) // MICROSECOND
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
@@ -44,73 +825,905 @@ class Base():
             return False
         return (self.id == other.id)
 
-    def to_json(self, for_serialization: bool = False) -> dict:
-        """ Convert the object a JSON dictionary
+    @classmethod
+    def hydrator(cls) -> Callable[[dict], TypeVar('Base')]:
+        """ Function building objects from their JSON records like
+        cls(**record), for bulk loads: generated from FIELDS to set the
+        attributes directly, parsing each distinct timestamp once.
+        Records without timestamps, and classes not declaring their
+        FIELDS, go through __init__
         """
-        result = {}
-        for key, value in self.__dict__.items():
-            if not for_serialization and key[0] == '_':
-                continue
-            if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
-            else:
-                result[key] = value
-        return result
+        if 'FIELDS' not in cls.__dict__:
+            return lambda record: cls(**record)
+        if COMPACT:
+            parse = timestamp_parser(lambda dt: (dt - EPOCH) // MICROSECOND)
+            created, updated = '_created_us', '_updated_us'
+        else:
+            parse = timestamp_parser()
+            created, updated = 'created_at', 'updated_at'
+        lines = [
+            "def hydrate(record):",
+            "    try:",
+            "        obj_id = record['id']",
+            "        created = record['created_at']",
+            "        created = cached(created) or parse(created)",
+            "        updated = record['updated_at']",
+            "        updated = cached(updated) or parse(updated)",
+            "    except (KeyError, TypeError):",
+            "        return cls(**record)",
+            "    get = record.get",
+            "    obj = new(cls)",
+            "    obj.id = obj_id",
+            "    obj.{} = created".format(created),
+            "    obj.{} = updated".format(updated),
+        ]
+        for field in cls.FIELDS[len(Base.FIELDS):]:
+            if not field.isidentifier():
+                raise ValueError("invalid field {!r}".format(field))
+            value = "get({!r})".format(field)
+            if COMPACT and field in cls.INTERNED:
+                value = "intern_value({})".format(value)
+            lines.append("    obj.{} = {}".format(field, value))
+        lines.append("    return obj")
+        namespace = {"cls": cls, "parse": parse, "cached": parse.cache.get,
+                     "new": object.__new__,
+                     "intern_value": intern_value}
+        exec("\n".join(lines), namespace)
+        return namespace["hydrate"]
+
+    def to_json(self, for_serialization: bool = False,
+                fields: Iterable[str] = None) -> dict:
+        """ Convert the object a JSON dictionary, with only the
+        attributes of fields when given
+        """
+        cls = self.__class__
+        if not COMPACT:
+            layout = tuple(self.__dict__)
+        elif 'FIELDS' in cls.__dict__:
+            layout = cls.FIELDS
+        else:
+            # no FIELDS nor slots of its own: the inherited slots, then
+            # the attributes of its __dict__
+            layout = cls.FIELDS + tuple(key for key in self.__dict__
+                                        if key not in cls.FIELDS)
+        if fields is not None:
+            fields = tuple(fields)
+        key = (cls, layout, for_serialization, fields)
+        serializer = SERIALIZERS.get(key)
+        if serializer is None:
+            if len(SERIALIZERS) >= 1024:
+                SERIALIZERS.clear()
+            serializer = SERIALIZERS[key] = cls.serializer(
+                layout, for_serialization, fields)
+        return serializer(self)
+
+    @classmethod
+    def serializer(cls, layout: tuple, for_serialization: bool,
+                   fields: tuple = None) -> Callable[[TypeVar('Base')], dict]:
+        """ Function returning to_json() of the objects whose attributes
+        are layout (the keys of their __dict__, or FIELDS in compact mode
+        where missing slots are skipped, followed by the keys of the
+        __dict__ of classes without FIELDS), generated once per layout
+        """
+        keys = [key for key in layout
+                if (for_serialization or key[0] != '_') and
+                (fields is None or key in fields)]
+        lines = ["def serialize(obj):"]
+        if COMPACT:
+            lines.append("    result = {}")
+            for i, key in enumerate(keys):
+                lines.extend([
+                    "    v{} = getattr(obj, {!r}, missing)".format(i, key),
+                    "    if v{} is not missing:".format(i),
+                    "        result[{0!r}] = v{1} if type(v{1}) is not "
+                    "datetime else fmt(v{1})".format(key, i)])
+            lines.append("    return result")
+        else:
+            lines.append("    attributes = obj.__dict__")
+            for i, key in enumerate(keys):
+                lines.append("    v{} = attributes[{!r}]".format(i, key))
+            lines.append("    return {")
+            for i, key in enumerate(keys):
+                lines.append("        {0!r}: v{1} if type(v{1}) is not "
+                             "datetime else fmt(v{1}),".format(key, i))
+            lines.append("    }")
+        namespace = {"datetime": datetime, "fmt": format_timestamp,
+                     "missing": UNINDEXED}
+        exec("\n".join(lines), namespace)
+        return namespace["serialize"]
+
+    @classmethod
+    def snapshot_path(cls) -> str:
+        """ Path of the file holding every object of the class: JSON
+        lines when lazy loading is on, one JSON object otherwise
+        """
+        if lazy_load():
+            return ".db_{}.jsonl".format(cls.__name__)
+        return ".db_{}.json".format(cls.__name__)
 
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file, then replay the journal. In the
+        deferred mode, unwritten changes are written first so the
+        reload does not drop them
+        """
+        while True:
+            # before the lock: the flusher takes it after its own
+            cls.flush()
+            with cls.rwlock().writing(), cls.locked(exclusive=False):
+                if FLUSHER is not None and FLUSHER.pending(cls):
+                    # changed again in the meantime
+                    continue
+                with timed(cls.__name__, "load_ms"):
+                    cls._load_from_file()
+                cls.publish()
+                return
+
+    @classmethod
+    def _load_from_file(cls):
+        """ Body of load_from_file(), under the lock of the class
         """
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
+        if isinstance(DATA.get(s_class), LazyObjects):
+            DATA[s_class].close()
         DATA[s_class] = {}
-        if not path.exists(file_path):
+        cls.rebuild_indexes()
+        mode = storage_mode()
+        backend = storage_backend(mode)
+        if backend is not None:
+            backend.load(cls)
+            return
+        if mode == "sharded":
+            cls.load_shards()
             return
+        if lazy_load() and path.exists(cls.snapshot_path()):
+            DATA[s_class] = LazyObjects(cls, cls.snapshot_path())
+        elif path.exists(file_path):
+            with open(file_path, 'r') as f:
+                objs_json = json.load(f)
+            with gc_paused():
+                DATA[s_class].update(zip(objs_json, map(
+                    cls.hydrator(), objs_json.values())))
+                cls._index_records(objs_json)
+        snapshot = snapshot_id(cls.snapshot_path())
+        SYNC[s_class] = (snapshot, cls.replay_journal())
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def _write_snapshot(cls, file_path: str, lines: bool) -> dict:
+        """ Replace file_path by every object of the class, as JSON lines
+        when lines is set. Returns the new offsets of the objects still
+        unloaded when writing JSON lines
+        """
+        s_class = cls.__name__
+        objs = DATA[s_class]
+        if not lines:
+            objs_json = {}
+            for obj_id, obj in list(objs.items()):
+                objs_json[obj_id] = obj.to_json(True)
+            with atomic_write(file_path) as f:
+                json.dump(objs_json, f)
+            return
+
+        # JSON lines: objects never loaded are copied as they are, and the
+        # keys file gets the index keys of each line for the next load
+        attrs = list(cls.INDEXES)
+        known = INDEX_KEYS.get(s_class, {})
+        columns = [[] for attr in attrs]
+        ids = []
+        starts = []
+        offsets = {}
+        offset = 0
+        with atomic_write(file_path, 'wb') as f:
+            for obj_id, obj in list(dict.items(objs)):
+                if isinstance(obj, Base):
+                    record = obj.to_json(True)
+                    line = (json.dumps(record) + "\n").encode()
+                    keys = [cls.index_key(attr, record.get(attr))
+                            for attr in attrs]
+                else:
+                    line = objs.raw_line(obj)
+                    offsets[obj_id] = offset
+                    keys = known.get(obj_id) if attrs else ()
+                    if dict.get(objs, obj_id) is not obj:
+                        # loaded and changed since: keys of another line
+                        keys = None
+                f.write(line)
+                if columns is not None and keys is not None:
+                    for column, key in zip(columns, keys):
+                        column.append(key)
+                else:
+                    columns = None
+                ids.append(obj_id)
+                starts.append(offset)
+                offset += len(line)
+        write_keys(file_path, ids, starts,
+                   None if columns is None else dict(zip(attrs, columns)))
+        if isinstance(objs, LazyObjects):
+            return offsets
+        return None
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
+        backend = storage_backend()
+        if backend is not None:
+            with timed(cls.__name__, "save_ms"):
+                backend.save_all(cls, DATA[cls.__name__].values())
+            return
+        if lazy_load() or storage_mode() == "shared":
+            with cls.locked():
+                cls.compact()
+            return
+        if storage_mode() == "sharded":
+            with timed(cls.__name__, "save_ms"):
+                cls.save_shards()
+            return
+        s_class = cls.__name__
+        file_path = ".db_{}.json".format(s_class)
+        with cls.file_lock(), timed(s_class, "save_ms"):
+            objs_json = {}
+            # one C call: no other thread runs while the items are read
+            for obj_id, obj in list(DATA[s_class].items()):
+                objs_json[obj_id] = obj.to_json(True)
+
+            with atomic_write(file_path) as f:
+                json.dump(objs_json, f)
+            cls.truncate_journal()
+
+    @classmethod
+    def shard_path(cls, shard: int, shards: int) -> str:
+        """ Path of one of the shards files of the class, named after
+        their number so that resharding never overwrites live shards
+        """
+        return ".db_{}.{}-{}.json".format(cls.__name__, shards, shard)
+
+    @classmethod
+    def manifest_path(cls) -> str:
+        """ Path of the file holding the number of shards of the class
+        """
+        return ".db_{}.shards.json".format(cls.__name__)
+
+    @classmethod
+    def _read_shard(cls, file_path: str) -> tuple:
+        """ Records and objects of a shard file, run by the loading
+        threads
+        """
+        with open(file_path, 'r') as f:
+            records = json.load(f)
+        hydrate = cls.hydrator()
+        return records, {obj_id: hydrate(record)
+                         for obj_id, record in records.items()}
+
+    @classmethod
+    def load_shards(cls):
+        """ Load the shards of the class in parallel threads. Without
+        shards yet, objects come from .db_<Class>.json (migration); the
+        shards are written again when MODEL_SHARDS changed
+        """
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        SHARD_IDS.pop(s_class, None)
+        if not path.exists(cls.manifest_path()):
+            if path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    objs_json = json.load(f)
+                with gc_paused():
+                    DATA[s_class].update(zip(objs_json, map(
+                        cls.hydrator(), objs_json.values())))
+                    cls._index_records(objs_json)
+            cls.save_shards()
+            return
+        with open(cls.manifest_path(), 'r') as f:
+            shards = json.load(f)["shards"]
+        paths = [cls.shard_path(i, shards) for i in range(shards)]
+        with gc_paused():
+            with ThreadPoolExecutor(min(shards, 8)) as pool:
+                parts = list(pool.map(cls._read_shard, paths))
+            shard_ids = []
+            for records, objs in parts:
+                DATA[s_class].update(objs)
+                cls._index_records(records)
+                shard_ids.append(dict.fromkeys(records))
+        SHARD_IDS[s_class] = shard_ids
+        if shards != shard_count():
+            cls.save_shards()
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def _shard_ids(cls) -> list:
+        """ IDs of the objects of each shard, computed from DATA with
+        shard_count() shards when the class was not loaded sharded
+        """
+        s_class = cls.__name__
+        if s_class not in SHARD_IDS:
+            shards = shard_count()
+            shard_ids = [{} for _ in range(shards)]
+            for obj_id in list(DATA.get(s_class, {})):
+                shard_ids[shard_of(obj_id, shards)][obj_id] = None
+            SHARD_IDS[s_class] = shard_ids
+        return SHARD_IDS[s_class]
+
+    @classmethod
+    def write_shard(cls, shard: int):
+        """ Rewrite one shard file atomically with its objects
+        """
+        shard_ids = cls._shard_ids()
+        objs = DATA[cls.__name__]
+        file_path = cls.shard_path(shard, len(shard_ids))
+        with cls.file_lock(), timed(cls.__name__, "save_ms"):
+            records = {}
+            for obj_id in list(shard_ids[shard]):
+                obj = objs.get(obj_id)
+                if obj is not None:
+                    records[obj_id] = obj.to_json(True)
+            with atomic_write(file_path) as f:
+                json.dump(records, f)
+
+    @classmethod
+    def save_shards(cls):
+        """ Write every object in shard_count() shards, then the manifest
+        pointing at them, then remove the shards it replaces
+        """
+        s_class = cls.__name__
+        old_shards = None
+        if path.exists(cls.manifest_path()):
+            with open(cls.manifest_path(), 'r') as f:
+                old_shards = json.load(f)["shards"]
+        SHARD_IDS.pop(s_class, None)
+        shards = len(cls._shard_ids())
+        for shard in range(shards):
+            cls.write_shard(shard)
+        with atomic_write(cls.manifest_path()) as f:
+            json.dump({"shards": shards}, f)
+        if old_shards is not None and old_shards != shards:
+            for shard in range(old_shards):
+                old_path = cls.shard_path(shard, old_shards)
+                if path.exists(old_path):
+                    os.remove(old_path)
+
+    @classmethod
+    def flush(cls):
+        """ Write the unwritten changes of the deferred mode now, of
+        every class when called on Base
+        """
+        if FLUSHER is not None:
+            FLUSHER.flush(None if cls is Base else cls)
+
+    @classmethod
+    def journal_path(cls) -> str:
+        """ Path of the journal of the class
+        """
+        return ".db_{}.log".format(cls.__name__)
+
+    @classmethod
+    def replay_journal(cls, start: int = 0) -> int:
+        """ Apply the journal from offset start on top of the loaded
+        objects, returns the offset after the last valid entry
+        """
+        s_class = cls.__name__
+        if not path.exists(cls.journal_path()):
+            return 0
+        hydrate = cls.hydrator()
+        with open(cls.journal_path(), 'rb+') as f:
+            f.seek(start)
+            valid_size = start
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete entry")
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn write of the last entry: drop it so the next
+                    # entries are not appended to it
+                    f.truncate(valid_size)
+                    break
+                valid_size += len(line)
+                if entry["op"] == "save":
+                    obj = hydrate(entry["obj"])
+                    DATA[s_class][obj.id] = obj
+                    obj._index()
+                else:
+                    DATA[s_class].pop(entry["id"], None)
+                    cls._unindex_id(entry["id"])
+        if valid_size > start:
+            cls.publish()
+        return valid_size
+
+    @classmethod
+    def append_to_journal(cls, entry: dict):
+        """ Append one change to the journal, compacting it when it
+        grows past journal_max_size()
+        """
+        s_class = cls.__name__
+        journal = JOURNALS.get(s_class)
+        if journal is None:
+            journal = open(cls.journal_path(), 'a')
+            JOURNALS[s_class] = journal
+        journal.write(json.dumps(entry) + "\n")
+        journal.flush()
+        if journal.tell() > journal_max_size():
+            cls.compact()
+        elif storage_mode() == "shared":
+            # written under the exclusive lock: nothing else to replay
+            SYNC[s_class] = (SYNC[s_class][0], journal.tell())
+
+    @classmethod
+    def compact(cls):
+        """ Rewrite the snapshot atomically with every object and empty
+        the journal
+        """
+        s_class = cls.__name__
+        file_path = cls.snapshot_path()
+        with cls.file_lock(), timed(s_class, "save_ms"):
+            offsets = cls._write_snapshot(file_path, lazy_load())
+            if offsets is not None:
+                DATA[s_class].rebase(file_path, offsets)
+            cls.truncate_journal()
+            SYNC[s_class] = (snapshot_id(file_path), 0)
+
+    @classmethod
+    def rwlock(cls) -> RWLock:
+        """ Reader-writer lock of the objects of the class in DATA:
+        changes hold it exclusive, reads needing several steps (an index
+        then the objects) hold it shared. Single lookups and snapshot()
+        need no lock. locked() takes it before the flock
+        """
+        lock = RW_LOCKS.get(cls.__name__)
+        if lock is None:
+            lock = RW_LOCKS.setdefault(cls.__name__, RWLock())
+        return lock
+
+    @classmethod
+    def file_lock(cls) -> threading.RLock:
+        """ Lock of the threads rewriting the files of the class: the
+        last to copy the objects is the last to rename its file. Taken
+        after rwlock() and locked()
+        """
+        lock = FILE_LOCKS.get(cls.__name__)
+        if lock is None:
+            lock = FILE_LOCKS.setdefault(cls.__name__, threading.RLock())
+        return lock
+
+    @classmethod
+    @contextlib.contextmanager
+    def locked(cls, exclusive: bool = True):
+        """ Context holding the class against the other threads and, in
+        the `shared` mode, the other processes: exclusive to change
+        objects (or to read-modify-write them), shared to read them.
+        Reentrant; the rwlock() of the class is always taken before the
+        flock, so that every thread takes them in the same order.
+        Shared, the class first catches up with the other processes:
+        refresh() cannot write under a read lock
+        """
+        rwlock = cls.rwlock()
+        shared = storage_mode() == "shared"
+        # the writer of the class catches up itself (save, refresh)
+        catch_up = (shared and not exclusive and
+                    rwlock.writer != threading.get_ident())
+        while True:
+            if catch_up:
+                cls.refresh()
+            with rwlock.writing() if exclusive else rwlock.reading():
+                if not shared:
+                    yield
+                    return
+                with cls._file_lock(exclusive):
+                    if not catch_up or cls._synced():
+                        yield
+                        return
+            # another process wrote between refresh() and the flock
+
+    @classmethod
+    @contextlib.contextmanager
+    def _file_lock(cls, exclusive: bool):
+        """ Advisory lock (flock) of .db_<Class>.lock, taken by the
+        first of the nested users in this process and made exclusive
+        for the time an exclusive one is nested in shared ones
+        """
+        s_class = cls.__name__
+        lock_path = path.abspath(".db_{}.lock".format(s_class))
+        guard = LOCK_GUARDS.get(s_class)
+        if guard is None:
+            guard = LOCK_GUARDS.setdefault(s_class, threading.Lock())
+        with guard:
+            depth, held = LOCK_DEPTH.get(s_class, (0, False))
+            pid, f = LOCKS.get(lock_path, (None, None))
+            if pid != os.getpid():
+                # a forked child gets its own open file, or its lock
+                # would be the one of its parent
+                f = open(lock_path, 'a')
+                LOCKS[lock_path] = (os.getpid(), f)
+            if depth == 0 or (exclusive and not held):
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            LOCK_DEPTH[s_class] = (depth + 1, held or exclusive)
+        try:
+            yield
+        finally:
+            with guard:
+                # shared users of several threads leave in any order
+                depth, exclusive_now = LOCK_DEPTH[s_class]
+                if depth == 1:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    exclusive_now = False
+                elif exclusive and not held:
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                    exclusive_now = False
+                LOCK_DEPTH[s_class] = (depth - 1, exclusive_now)
+
+    @classmethod
+    def refresh(cls):
+        """ Catch up with the changes of the other processes in the
+        `shared` mode: new journal entries are replayed, a rewritten
+        snapshot is loaded again
+        """
+        if storage_mode() != "shared" or cls._synced():
+            return
+        if cls.rwlock().reads_held():
+            # caught up by locked(), whose flock keeps the other
+            # processes from writing since
+            return
+        s_class = cls.__name__
+        with cls.rwlock().writing(), cls.locked(exclusive=False):
+            snapshot, offset = SYNC.get(s_class, (None, None))
+            if offset is None or \
+                    snapshot_id(cls.snapshot_path()) != snapshot:
+                cls._load_from_file()
+                cls.publish()
+            else:
+                SYNC[s_class] = (snapshot, cls.replay_journal(offset))
+
+    @classmethod
+    def _synced(cls) -> bool:
+        """ Whether the class holds the last changes written by the
+        other processes in the `shared` mode
+        """
+        journal = snapshot_id(cls.journal_path())
+        current = (snapshot_id(cls.snapshot_path()),
+                   0 if journal is None else journal[2])
+        return SYNC.get(cls.__name__) == current
+
+    @classmethod
+    def truncate_journal(cls):
+        """ Empty the journal once the snapshot holds all its changes
+        """
+        journal = JOURNALS.pop(cls.__name__, None)
+        if journal is not None:
+            journal.close()
+        if path.exists(cls.journal_path()):
+            open(cls.journal_path(), 'w').close()
+
+    @classmethod
+    def index_key(cls, attr: str, value):
+        """ Key of value in the index of attr
+        """
+        normalize = cls.INDEXES[attr]
+        return value if normalize is None else normalize(value)
+
+    @classmethod
+    def rebuild_indexes(cls):
+        """ Rebuild the indexes of the class from DATA
+        """
+        s_class = cls.__name__
+        INDEX_DATA.pop(s_class, None)
+        INDEX_KEYS.pop(s_class, None)
+        if not cls.INDEXES:
+            return
+        INDEX_DATA[s_class] = {attr: {} for attr in cls.INDEXES}
+        INDEX_KEYS[s_class] = {}
+        objs = DATA.get(s_class, {})
+        for obj_id, obj in list(dict.items(objs)):
+            if isinstance(obj, Base):
+                obj._index()
+            else:
+                cls._index_values(obj_id, objs.raw_record(obj))
+
+    @classmethod
+    def _index_values(cls, obj_id: str, values: dict):
+        """ Add an object to the indexes of its class, values holding
+        its indexed attributes
+        """
+        if not cls.INDEXES:
+            return
+        s_class = cls.__name__
+        if s_class not in INDEX_DATA:
+            INDEX_DATA[s_class] = {attr: {} for attr in cls.INDEXES}
+            INDEX_KEYS[s_class] = {}
+        if obj_id in INDEX_KEYS[s_class]:
+            cls._unindex_id(obj_id)
+        keys = []
+        for attr, index in INDEX_DATA[s_class].items():
+            # inlined index_key(), called for every object on load
+            normalize = cls.INDEXES[attr]
+            key = values.get(attr)
+            if normalize is not None:
+                key = normalize(key)
+            try:
+                # a key of one object maps to its id, of several to a dict
+                ids = index.setdefault(key, obj_id)
+                if type(ids) is dict:
+                    ids[obj_id] = None
+                elif ids != obj_id:
+                    index[key] = {ids: None, obj_id: None}
+            except TypeError:
+                # unhashable value: only found by scanning
+                key = UNINDEXED
+            keys.append(key)
+        # keys in the order of INDEX_DATA[s_class], to unindex the object
+        INDEX_KEYS[s_class][obj_id] = tuple(keys)
+
+    @classmethod
+    def _index_records(cls, records: dict):
+        """ Add objects not indexed yet to the indexes of their class,
+        records mapping their IDs to their JSON records: one pass per
+        index instead of one _index_values() call per object
+        """
+        if not cls.INDEXES:
+            return
+        columns = []
+        for attr in cls.INDEXES:
+            normalize = cls.INDEXES[attr]
+            keys = [record.get(attr) for record in records.values()]
+            if normalize is not None:
+                keys = list(map(normalize, keys))
+            columns.append(keys)
+        cls._index_columns(list(records), columns)
+
+    @classmethod
+    def _index_columns(cls, ids: list, columns: list):
+        """ Add objects not indexed yet to the indexes of their class,
+        columns holding the keys of ids in each index, in the order of
+        INDEX_DATA
+        """
+        if not cls.INDEXES:
+            return
+        s_class = cls.__name__
+        if s_class not in INDEX_DATA:
+            INDEX_DATA[s_class] = {attr: {} for attr in cls.INDEXES}
+            INDEX_KEYS[s_class] = {}
+        for index, keys in zip(INDEX_DATA[s_class].values(), columns):
+            setdefault = index.setdefault
+            for position, (obj_id, key) in enumerate(zip(ids, keys)):
+                try:
+                    ids_of_key = setdefault(key, obj_id)
+                    if ids_of_key is not obj_id:
+                        if type(ids_of_key) is dict:
+                            ids_of_key[obj_id] = None
+                        elif ids_of_key != obj_id:
+                            index[key] = {ids_of_key: None, obj_id: None}
+                except TypeError:
+                    keys[position] = UNINDEXED
+        INDEX_KEYS[s_class].update(zip(ids, zip(*columns)))
+
+    @classmethod
+    def _unindex_id(cls, obj_id: str):
+        """ Remove an object from the indexes of its class
+        """
+        s_class = cls.__name__
+        keys = INDEX_KEYS.get(s_class, {}).pop(obj_id, None)
+        if keys is None:
+            return
+        for index, key in zip(INDEX_DATA[s_class].values(), keys):
+            if key is UNINDEXED:
+                continue
+            ids = index.get(key)
+            if type(ids) is dict:
+                ids.pop(obj_id, None)
+                if len(ids) == 1:
+                    index[key] = next(iter(ids))
+            elif ids == obj_id:
+                del index[key]
+
+    def _index(self):
+        """ Add the object to the indexes of its class, with its current
+        attribute values
+        """
+        cls = self.__class__
+        if cls.INDEXES:
+            cls._index_values(self.id, {attr: getattr(self, attr, None)
+                                        for attr in cls.INDEXES})
+
+    def _unindex(self):
+        """ Remove the object from the indexes of its class
+        """
+        self.__class__._unindex_id(self.id)
 
     def save(self):
         """ Save current object
         """
         s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        mode = storage_mode()
+        backend = storage_backend(mode)
+        if backend is not None:
+            backend.save(self)
+            return
+        with self.__class__.locked():
+            if mode == "shared":
+                self.__class__.refresh()
+            previous = dict.get(DATA[s_class], self.id)
+            DATA[s_class][self.id] = self
+            if previous is not self:
+                self.__class__.publish()
+            self._index()
+            change_feed().emit("create" if previous is None else "update",
+                               s_class, self.id)
+            if mode in ("journal", "shared"):
+                self.__class__.append_to_journal({"op": "save",
+                                                  "obj": self.to_json(True)})
+            elif mode == "sharded":
+                shard_ids = self.__class__._shard_ids()
+                shard = shard_of(self.id, len(shard_ids))
+                shard_ids[shard][self.id] = None
+            elif mode == "deferred":
+                flusher().mark(self.__class__)
+        # files are rewritten from a copy of the objects: readers and
+        # writers go on meanwhile
+        if mode == "sharded":
+            self.__class__.write_shard(shard)
+        elif mode not in ("journal", "shared", "deferred"):
+            self.__class__.save_to_file()
 
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
+        mode = storage_mode()
+        backend = storage_backend(mode)
+        if backend is not None:
+            backend.remove(self)
+            return
+        with self.__class__.locked():
+            if mode == "shared":
+                self.__class__.refresh()
+            if DATA[s_class].get(self.id) is None:
+                return
             del DATA[s_class][self.id]
+            self.__class__.publish()
+            self._unindex()
+            change_feed().emit("delete", s_class, self.id)
+            if mode in ("journal", "shared"):
+                self.__class__.append_to_journal({"op": "remove",
+                                                  "id": self.id})
+            elif mode == "sharded":
+                shard_ids = self.__class__._shard_ids()
+                shard = shard_of(self.id, len(shard_ids))
+                shard_ids[shard].pop(self.id, None)
+            elif mode == "deferred":
+                flusher().mark(self.__class__)
+        if mode == "sharded":
+            self.__class__.write_shard(shard)
+        elif mode not in ("journal", "shared", "deferred"):
             self.__class__.save_to_file()
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
+        mode = storage_mode()
+        backend = storage_backend(mode)
+        if backend is not None:
+            return backend.count(cls)
+        if mode == "shared":
+            cls.refresh()
         s_class = cls.__name__
         return len(DATA[s_class].keys())
 
+    @classmethod
+    def memory_stats(cls, sample: int = 100) -> dict:
+        """ Memory used by the class in DATA: the objects are counted
+        and sample of them are measured by object_size() to estimate
+        the bytes of all (unloaded objects of a lazy store are offsets),
+        the indexes are measured without their keys, which are mostly
+        attribute values. With the last load and save durations
+        """
+        s_class = cls.__name__
+        store = DATA.get(s_class, {})
+        with cls.rwlock().reading():
+            count = len(store)
+            step = max(1, count // max(sample, 1))
+            # every step-th object, without copying nor loading them
+            sampled = [object_size(obj) for obj in
+                       itertools.islice(dict.values(store), 0, None, step)]
+            objects = (sum(sampled) * count // len(sampled)
+                       if sampled else 0)
+            indexes = {}
+            for attr, index in INDEX_DATA.get(s_class, {}).items():
+                # keys shared by several objects hold a dict of IDs
+                step = max(1, len(index) // max(sample, 1))
+                buckets = [sys.getsizeof(ids) if type(ids) is dict else 0
+                           for ids in itertools.islice(index.values(), 0,
+                                                       None, step)]
+                size = sys.getsizeof(index)
+                if buckets:
+                    size += sum(buckets) * len(index) // len(buckets)
+                indexes[attr] = {"keys": len(index), "bytes": size}
+            keys = INDEX_KEYS.get(s_class)
+            if keys:
+                # a tuple of the same length for every object
+                indexes["_keys"] = {"keys": len(keys), "bytes": (
+                    sys.getsizeof(keys) + len(keys) *
+                    sys.getsizeof(next(iter(keys.values()))))}
+        stats = {"count": count,
+                 "sampled": len(sampled),
+                 "objects_bytes": objects,
+                 "store_bytes": sys.getsizeof(store),
+                 "indexes": indexes}
+        stats["total_bytes"] = (objects + stats["store_bytes"] +
+                                sum(i["bytes"] for i in indexes.values()))
+        stats.update(TIMINGS.get(s_class, {}))
+        return stats
+
+    @staticmethod
+    def memory_growth(top: int = 10) -> List[dict]:
+        """ Lines of code whose allocations grew the most since the
+        previous call, from tracemalloc snapshots. The first call starts
+        tracing (which slows every allocation) and returns []
+        """
+        global TRACE
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            TRACE = None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        previous, TRACE = TRACE, snapshot
+        if previous is None:
+            return []
+        return [{"where": "{}:{}".format(stat.traceback[0].filename,
+                                         stat.traceback[0].lineno),
+                 "size_diff_bytes": stat.size_diff,
+                 "count_diff": stat.count_diff}
+                for stat in snapshot.compare_to(previous, "lineno")[:top]
+                if stat.size_diff > 0]
+
+    @staticmethod
+    def stop_memory_growth():
+        """ Stop the tracing started by memory_growth()
+        """
+        global TRACE
+        TRACE = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @classmethod
+    def publish(cls):
+        """ Start a new version of the objects of the class, called
+        after objects are added to or removed from DATA: the next
+        snapshot() is taken again
+        """
+        s_class = cls.__name__
+        with VERSION_LOCK:
+            generation = VERSIONS.get(s_class, (0, None))[0]
+            VERSIONS[s_class] = (generation + 1, None)
+
+    @classmethod
+    def snapshot(cls) -> tuple:
+        """ Tuple of every object of the class in the current version,
+        shared by the readers until objects are added or removed:
+        iterating it needs no copy nor lock. Changes of an object
+        already stored are seen in place
+        """
+        s_class = cls.__name__
+        generation, objs = VERSIONS.get(s_class, (0, None))
+        if objs is not None:
+            return objs
+        store = DATA.get(s_class, {})
+        if type(store) is dict:
+            # one C call: no other thread runs while values are read
+            objs = tuple(store.values())
+        else:
+            objs = tuple(obj for obj in map(store.get, tuple(store))
+                         if obj is not None)
+        with VERSION_LOCK:
+            # a writer published meanwhile: objs may be out of date
+            if VERSIONS.get(s_class, (0, None))[0] == generation:
+                VERSIONS[s_class] = (generation, objs)
+        return objs
+
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
-        """ Return all objects
+        """ Return all objects: the snapshot() tuple, or a list from a
+        storage backend. query() yields them one at a time
         """
         return cls.search()
 
@@ -118,20 +1731,223 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
+        mode = storage_mode()
+        backend = storage_backend(mode)
+        if backend is not None:
+            return backend.get(cls, id)
+        if mode == "shared":
+            cls.refresh()
         s_class = cls.__name__
         return DATA[s_class].get(id)
 
     @classmethod
-    def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
-        """ Search all objects with matching attributes
+    def _candidate_ids(cls, attributes: dict, ignore_case: bool,
+                       one_of: dict = None) -> Iterable[str]:
+        """ IDs of the objects that may match attributes and have one of
+        the values of one_of, found in the indexes of these attributes.
+        None when no index applies
         """
-        s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
+        indexes = INDEX_DATA.get(cls.__name__)
+        if not indexes:
+            return None
+        lookups = [(k, (v,)) for k, v in attributes.items()]
+        lookups.extend((one_of or {}).items())
+        ids = None
+        for k, values in lookups:
+            if k not in indexes:
+                continue
+            if ignore_case and cls.INDEXES[k] is not casefold:
+                continue
+            found = {}
+            try:
+                for v in values:
+                    ids_v = indexes[k].get(cls.index_key(k, v))
+                    if ids_v is None:
+                        continue
+                    if type(ids_v) is not dict:
+                        ids_v = (ids_v,)
+                    if len(values) == 1:
+                        found = ids_v
+                    else:
+                        found.update(dict.fromkeys(ids_v))
+            except TypeError:
+                continue
+            if ids is None:
+                ids = found
+            else:
+                ids = {obj_id: None for obj_id in ids if obj_id in found}
+        return ids
+
+    @classmethod
+    def _candidates(cls, attributes: dict,
+                    ignore_case: bool) -> Iterable[TypeVar('Base')]:
+        """ Objects that may match attributes: the ones found in the
+        indexes of the searched attributes, or all objects
+        """
+        objs = DATA[cls.__name__]
+        ids = cls._candidate_ids(attributes, ignore_case)
+        if ids is None:
+            return cls.snapshot()
+        return [obj for obj in map(objs.get, list(ids)) if obj is not None]
+
+    @staticmethod
+    def match(obj: TypeVar('Base'), attributes: dict,
+              ignore_case: bool) -> bool:
+        """ Whether obj has all the attributes, string attributes are
+        compared case-insensitively when ignore_case is set
+        """
+        for k, v in attributes.items():
+            if ignore_case:
+                if casefold(getattr(obj, k)) != casefold(v):
+                    return False
+            elif (getattr(obj, k) != v):
+                return False
+        return True
+
+    @staticmethod
+    def order_key(obj: TypeVar('Base'), order_by: str) -> tuple:
+        """ Sort key of obj on the attribute order_by, then on its ID:
+        None sorts first
+        """
+        value = getattr(obj, order_by, None)
+        return (value is not None, value, obj.id)
+
+    @classmethod
+    def query(cls, attributes: dict = None, prefix: dict = None,
+              ranges: dict = None, one_of: dict = None,
+              order_by: str = None, reverse: bool = False,
+              limit: int = None, offset: int = 0, after: tuple = None,
+              stats: dict = None) -> Iterator[TypeVar('Base')]:
+        """ Objects matching every predicate, yielded one at a time:
+          - attributes: attribute name -> equal value
+          - prefix: attribute name -> prefix of its string value
+          - ranges: attribute name -> (low, high), low included and high
+            excluded, None for no bound (ex: created_at)
+          - one_of: attribute name -> accepted values
+        Equalities and one_of use the indexes of the class. Objects come
+        in the order of the store (or of the index used), or sorted on
+        order_by then ID (descending with reverse); after is then the
+        cursor of the last object of the previous page, for keyset
+        pagination. stats, when given, is
+        updated with the number of objects scanned, the number returned
+        and the cursor of the last one returned
+        """
+        if after is not None and order_by is None:
+            raise ValueError("keyset cursors need order_by")
+        if stats is None:
+            stats = {}
+        stats.update(scanned=0, returned=0, cursor=None)
+        return cls._query(attributes or {}, prefix or {}, ranges or {},
+                          {k: list(v) for k, v in (one_of or {}).items()},
+                          order_by, reverse, limit, offset, after, stats)
+
+    @classmethod
+    def _query(cls, attributes: dict, prefix: dict, ranges: dict,
+               one_of: dict, order_by: str, reverse: bool, limit: int,
+               offset: int, after: tuple,
+               stats: dict) -> Iterator[TypeVar('Base')]:
+        """ Generator of query(), with its arguments normalized
+        """
+        mode = storage_mode()
+        backend = storage_backend(mode)
+        if backend is not None:
+            objs = iter(backend.search(cls, attributes, False))
+        else:
+            if mode == "shared":
+                cls.refresh()
+            store = DATA[cls.__name__]
+            with cls.rwlock().reading():
+                ids = cls._candidate_ids(attributes, False, one_of)
+                if ids is not None:
+                    ids = list(ids)
+            if ids is None and type(store) is dict:
+                objs = cls.snapshot()
+            else:
+                # IDs taken now: objects are looked up (and loaded from
+                # a lazy store) only once reached, removed ones skipped
+                objs = (store.get(obj_id) for obj_id in
+                        (tuple(store) if ids is None else ids))
+
+        # one check per predicate, built once for the whole scan
+        checks = []
+        if attributes:
+            checks.append(lambda obj: cls.match(obj, attributes, False))
+        for k, start in prefix.items():
+            checks.append(lambda obj, k=k, start=start: isinstance(
+                getattr(obj, k, None), str) and getattr(obj, k).startswith(
+                    start))
+        for k, (low, high) in ranges.items():
+            checks.append(lambda obj, k=k, low=low, high=high: (
+                getattr(obj, k, None) is not None and
+                (low is None or getattr(obj, k) >= low) and
+                (high is None or getattr(obj, k) < high)))
+        for k, values in one_of.items():
+            checks.append(lambda obj, k=k, values=values:
+                          getattr(obj, k, None) in values)
+
+        def _match(obj):
+            if obj is None:
+                return False
+            stats['scanned'] += 1
+            for check in checks:
+                if not check(obj):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        end = None if limit is None else offset + limit
+        if type(objs) is tuple and not checks and order_by is None:
+            # the whole snapshot is no copy: t[0:None] is t
+            page = objs[offset:end]
+            stats['scanned'] = min(len(objs), offset + len(page))
+            stats['returned'] = len(page)
+            yield from page
+            return
+        found = filter(_match, objs)
+        if order_by is None:
+            found = itertools.islice(found, offset, end)
+        else:
+            # (key, object) pairs: keys end with the unique ID, so the
+            # objects themselves are never compared
+            keyed = ((cls.order_key(obj, order_by), obj) for obj in found)
+            if after is not None:
+                if reverse:
+                    keyed = (pair for pair in keyed if pair[0] < after)
+                else:
+                    keyed = (pair for pair in keyed if pair[0] > after)
+            if end is None:
+                keyed = sorted(keyed, reverse=reverse)[offset:]
+            elif reverse:
+                keyed = heapq.nlargest(end, keyed)[offset:]
+            else:
+                keyed = heapq.nsmallest(end, keyed)[offset:]
+            for key, obj in keyed:
+                stats['returned'] += 1
+                stats['cursor'] = key
+                yield obj
+            return
+        for obj in found:
+            stats['returned'] += 1
+            yield obj
+
+    @classmethod
+    def search(cls, attributes: dict = {},
+               ignore_case: bool = False) -> List[TypeVar('Base')]:
+        """ Search all objects with matching attributes, string
+        attributes are compared case-insensitively when ignore_case is
+        set. Without attributes, the snapshot() tuple itself is returned
+        """
+        mode = storage_mode()
+        backend = storage_backend(mode)
+        if backend is not None:
+            return backend.search(cls, attributes, ignore_case)
+        if mode == "shared":
+            cls.refresh()
+        if not attributes:
+            return cls.snapshot()
+
+        def _search(obj):
+            return cls.match(obj, attributes, ignore_case)
+
+        with cls.rwlock().reading():
+            return list(filter(_search, cls._candidates(attributes,
+                                                        ignore_case)))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+""" Storage backends module
+
+The JSON files (MODEL_STORAGE=json or journal) are kept by Base itself
+in DATA. Any other storage mode names a backend of BACKENDS, which
+implements the Storage interface
+"""
+from os import getenv, path
+from typing import Iterable, List, Optional, TypeVar
+import json
+import sqlite3
+import threading
+
+from models.base import Base, casefold
+
+
+class Storage():
+    """ Interface of a storage backend: Base forwards its persistence
+    methods to it
+    """
+
+    def load(self, cls: type):
+        """ Prepare the storage of the class, called by load_from_file()
+        """
+        raise NotImplementedError()
+
+    def save_all(self, cls: type, objs: Iterable[TypeVar('Base')]):
+        """ Store every object of objs at once
+        """
+        raise NotImplementedError()
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or update one object
+        """
+        raise NotImplementedError()
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete one object
+        """
+        raise NotImplementedError()
+
+    def count(self, cls: type) -> int:
+        """ Number of objects of the class
+        """
+        raise NotImplementedError()
+
+    def get(self, cls: type, obj_id: str) -> Optional[TypeVar('Base')]:
+        """ Object of the class with this ID, or None
+        """
+        raise NotImplementedError()
+
+    def search(self, cls: type, attributes: dict,
+               ignore_case: bool) -> List[TypeVar('Base')]:
+        """ Objects of the class matching attributes, like Base.search()
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """ Release the resources of the backend
+        """
+
+
+# types SQLite stores as they are
+SQL_TYPES = (str, int, float, bytes)
+
+
+class SQLiteStorage(Storage):
+    """ One table per class holding each object as JSON, with a column
+    and an SQL index for every attribute of the class INDEXES
+    """
+
+    OPENED = {}
+
+    @classmethod
+    def open(cls) -> 'SQLiteStorage':
+        """ Backend of the database at MODEL_SQLITE_PATH (.db.sqlite3 by
+        default), shared by every caller
+        """
+        db_path = path.abspath(getenv("MODEL_SQLITE_PATH", ".db.sqlite3"))
+        if db_path not in cls.OPENED:
+            cls.OPENED[db_path] = cls(db_path)
+        return cls.OPENED[db_path]
+
+    def __init__(self, db_path: str):
+        """ Initialize the backend, connections are opened per thread
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """ Connection of the current thread
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    @staticmethod
+    def table(cls: type) -> str:
+        """ Quoted table name of the class
+        """
+        return '"{}"'.format(cls.__name__)
+
+    @staticmethod
+    def sql_key(cls: type, attr: str, value):
+        """ Value of the index column of attr, NULL when SQLite cannot
+        store the index key
+        """
+        key = cls.index_key(attr, value)
+        return key if isinstance(key, SQL_TYPES) else None
+
+    def row(self, obj: TypeVar('Base')) -> tuple:
+        """ Values of the columns of an object
+        """
+        cls = obj.__class__
+        return ((obj.id, json.dumps(obj.to_json(True))) +
+                tuple(self.sql_key(cls, attr, getattr(obj, attr, None))
+                      for attr in cls.INDEXES))
+
+    def upsert(self, cls: type) -> str:
+        """ Statement inserting or updating one object, keeping its
+        position when it is updated
+        """
+        columns = ["id", "data"] + ['"{}"'.format(a) for a in cls.INDEXES]
+        return ("INSERT INTO {} ({}) VALUES ({}) ON CONFLICT(id) DO UPDATE "
+                "SET {}").format(
+                    self.table(cls), ", ".join(columns),
+                    ", ".join("?" * len(columns)),
+                    ", ".join("{0} = excluded.{0}".format(c)
+                              for c in columns[1:]))
+
+    def load(self, cls: type):
+        """ Create the table and its indexes. A new table is filled from
+        .db_<Class>.json and .db_<Class>.log when they exist
+        """
+        table = self.table(cls)
+        with self.db as db:
+            exists = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                "name = ?", (cls.__name__,)).fetchone()
+            columns = "".join(', "{}"'.format(a) for a in cls.INDEXES)
+            db.execute("CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY KEY, "
+                       "data TEXT NOT NULL{})".format(table, columns))
+            for attr in cls.INDEXES:
+                db.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" ON {2} '
+                           '("{1}")'.format(cls.__name__, attr, table))
+        if not exists:
+            records = self.file_records(cls)
+            if records:
+                hydrate = cls.hydrator()
+                self.save_all(cls, (hydrate(r) for r in records.values()))
+
+    @staticmethod
+    def file_records(cls: type) -> dict:
+        """ Records of the JSON files of the class, journal applied
+        """
+        records = {}
+        file_path = ".db_{}.json".format(cls.__name__)
+        if path.exists(file_path):
+            with open(file_path, 'r') as f:
+                records = json.load(f)
+        if path.exists(cls.journal_path()):
+            with open(cls.journal_path(), 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if entry["op"] == "save":
+                        records[entry["obj"]["id"]] = entry["obj"]
+                    else:
+                        records.pop(entry["id"], None)
+        return records
+
+    def save_all(self, cls: type, objs: Iterable[TypeVar('Base')]):
+        """ Store every object of objs in one transaction
+        """
+        with self.db as db:
+            db.executemany(self.upsert(cls), (self.row(o) for o in objs))
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or update one object in its own transaction
+        """
+        with self.db as db:
+            db.execute(self.upsert(obj.__class__), self.row(obj))
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete one object in its own transaction
+        """
+        with self.db as db:
+            db.execute("DELETE FROM {} WHERE id = ?".format(
+                self.table(obj.__class__)), (obj.id,))
+
+    def count(self, cls: type) -> int:
+        """ Number of rows of the table
+        """
+        return self.db.execute("SELECT COUNT(*) FROM {}".format(
+            self.table(cls))).fetchone()[0]
+
+    def get(self, cls: type, obj_id: str) -> Optional[TypeVar('Base')]:
+        """ Object of the row with this ID, or None
+        """
+        row = self.db.execute("SELECT data FROM {} WHERE id = ?".format(
+            self.table(cls)), (obj_id,)).fetchone()
+        return None if row is None else cls(**json.loads(row[0]))
+
+    def search(self, cls: type, attributes: dict,
+               ignore_case: bool) -> List[TypeVar('Base')]:
+        """ Rows selected through the index columns of the searched
+        attributes, then filtered on every attribute by Base.match()
+        """
+        where = []
+        params = []
+        for k, v in attributes.items():
+            if k not in cls.INDEXES:
+                continue
+            if ignore_case and cls.INDEXES[k] is not casefold:
+                continue
+            key = cls.index_key(k, v)
+            if key is not None and not isinstance(key, SQL_TYPES):
+                continue
+            where.append('"{}" IS ?'.format(k))
+            params.append(key)
+        query = "SELECT data FROM {}".format(self.table(cls))
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY rowid"
+        hydrate = cls.hydrator()
+        objs = (hydrate(json.loads(row[0]))
+                for row in self.db.execute(query, params))
+        return [obj for obj in objs
+                if Base.match(obj, attributes, ignore_case)]
+
+    def close(self):
+        """ Close the connections of every thread
+        """
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+# storage mode -> factory of its backend
+BACKENDS = {
+    "sqlite": SQLiteStorage.open,
+}
+
+
+def close_backends():
+    """ Close every opened backend
+    """
+    for backend in SQLiteStorage.OPENED.values():
+        backend.close()
+    SQLiteStorage.OPENED.clear()
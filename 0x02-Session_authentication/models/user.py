@@ -2,21 +2,27 @@
 """ User module
 """
 import hashlib
-from models.base import Base
+from models.base import COMPACT, Base, casefold, intern_value
 
 
 class User(Base):
     """ User class
     """
 
+    INDEXES = {'email': casefold}
+    FIELDS = Base.FIELDS + ('email', '_password', 'first_name', 'last_name')
+    INTERNED = ('first_name', 'last_name')
+    if COMPACT:
+        __slots__ = FIELDS[len(Base.FIELDS):]
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
         """
         super().__init__(*args, **kwargs)
         self.email = kwargs.get('email')
         self._password = kwargs.get('_password')
-        self.first_name = kwargs.get('first_name')
-        self.last_name = kwargs.get('last_name')
+        self.first_name = intern_value(kwargs.get('first_name'))
+        self.last_name = intern_value(kwargs.get('last_name'))
 
     @property
     def password(self) -> str: